@@ -12,10 +12,78 @@
 # Author: Derrick Karpo
 # Date:   January 10, 2012
 #
+# Notes:
+# o Batch mode ('-b') requires NumPy and streams the CSV output in chunks
+#   so millions of PRTimes can be converted with bounded memory.
+#   - $ sudo apt-get install python3-numpy
+# o Other forensic timestamps can be decoded in batch mode with '-f', one
+#   format per comma separated input column or 'auto' to guess a column's
+#   epoch and unit (ie. -f prtime webkit auto).
+# o Timestamp columns can be converted straight out of an SQLite database
+#   such as Firefox's places.sqlite, which is opened read-only.  Rows are
+#   written as CSV or to a table in a new database (ie. -d places.sqlite
+#   -T moz_places -C last_visit_date -o converted.sqlite).
+#
 
+import os
 import sys
+import csv
+import time
+import sqlite3
+import urllib.parse
 import datetime
 import argparse
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# number of PRTimes converted per chunk in batch mode
+CHUNK_SIZE = 1000000
+
+# datetime64 microsecond bounds that 'datetime' can represent
+DATETIME_MIN_US = -62135596800000000
+DATETIME_MAX_US = 253402300799999999
+
+# local time offsets are looked up once per day, or once per 15 minute
+# bucket (the finest granularity of any timezone transition) on days
+# where the offset changes
+DAY_US = 86400 * 1000000
+LOCALTIME_BUCKET_US = 900 * 1000000
+
+# timestamp formats as (epoch offset from 1970 in microseconds, multiplier,
+# divisor) where microseconds since 1970 = value * multiplier / divisor + offset
+TIMESTAMP_FORMATS = {
+    'prtime':   (0, 1, 1),                     # microseconds since 1970
+    'unix':     (0, 1000000, 1),               # seconds since 1970
+    'unix_ms':  (0, 1000, 1),                  # milliseconds since 1970
+    'unix_us':  (0, 1, 1),                     # microseconds since 1970
+    'unix_ns':  (0, 1, 1000),                  # nanoseconds since 1970
+    'webkit':   (-11644473600000000, 1, 1),    # microseconds since 1601
+    'filetime': (-11644473600000000, 1, 10),   # 100 nanoseconds since 1601
+    'cocoa':    (978307200000000, 1000000, 1), # seconds since 2001
+    'hfs':      (-2082844800000000, 1000000, 1), # seconds since 1904
+    'gps':      (315964800000000, 1000000, 1), # seconds since 1980-01-06
+}
+
+# formats tried by auto-detection in order of preference.  'unix_us' is the
+# same as 'prtime' and GPS seconds can't be told apart from Unix seconds.
+AUTO_FORMATS = ('prtime', 'unix', 'unix_ms', 'unix_ns', 'webkit',
+                'filetime', 'cocoa', 'hfs')
+
+# plausible artifact times for auto-detection, 1990 to 20 years from now
+PLAUSIBLE_MIN_US = 631152000000000
+PLAUSIBLE_FUTURE_US = 20 * 365 * DAY_US
+
+# UTC leap seconds since the GPS epoch, GPS time doesn't include them
+GPS_LEAP_SECONDS = ('1981-07-01', '1982-07-01', '1983-07-01', '1985-07-01',
+                    '1988-01-01', '1990-01-01', '1991-01-01', '1992-07-01',
+                    '1993-07-01', '1994-07-01', '1996-01-01', '1997-07-01',
+                    '1999-01-01', '2006-01-01', '2009-01-01', '2012-07-01',
+                    '2015-07-01', '2017-01-01')
 
 
 def convert_prtime(prtime):
@@ -29,17 +97,262 @@ def convert_prtime(prtime):
         return "%i, %s, %s" % (prtime, "invalid", "invalid")
 
 
+def lookup_offsets(seconds):
+    """Return the local UTC offsets in microseconds for an array of seconds
+       since the epoch and a mask of offsets that could be found"""
+    unique, inverse = np.unique(seconds, return_inverse=True)
+    offsets = np.zeros(len(unique), dtype=np.int64)
+    found = np.ones(len(unique), dtype=bool)
+    for index, second in enumerate(unique.tolist()):
+        try:
+            offsets[index] = time.localtime(second).tm_gmtoff * 1000000
+        except (OverflowError, OSError, ValueError):
+            found[index] = False
+    return offsets[inverse], found[inverse]
+
+
+def localtime_offsets(utc_us):
+    """Return the local UTC offsets in microseconds for an array of
+       microsecond timestamps and a mask of offsets that could be found"""
+    # look up the offset once per day and only go finer on the days that
+    # contain a timezone transition
+    days, inverse = np.unique(utc_us // DAY_US, return_inverse=True)
+    start, start_found = lookup_offsets(days * (DAY_US // 1000000))
+    end, end_found = lookup_offsets((days + 1) * (DAY_US // 1000000))
+    offsets = start[inverse]
+    found = start_found[inverse]
+
+    changed = ((start != end) | (start_found != end_found))[inverse]
+    if changed.any():
+        buckets = utc_us[changed] // LOCALTIME_BUCKET_US
+        offsets[changed], found[changed] = \
+            lookup_offsets(buckets * (LOCALTIME_BUCKET_US // 1000000))
+    return offsets, found
+
+
+def format_datetime64(us, valid):
+    """Format microsecond timestamps like str(datetime), 'invalid' if not valid"""
+    strings = np.datetime_as_string(np.where(valid, us, 0).astype('datetime64[us]'),
+                                    unit='us').astype('U26')
+    strings = np.char.replace(strings, 'T', ' ')
+    # str(datetime) drops the microseconds when they are zero
+    whole = (us % 1000000) == 0
+    strings[whole] = strings[whole].astype('U19')
+    strings[~valid] = 'invalid'
+    return strings
+
+
+def decode_timestamps(values, fmt):
+    """Decode an int64 or float64 array of timestamps in a TIMESTAMP_FORMATS
+       format to microseconds since 1970 UTC and a mask of valid values"""
+    offset, multiplier, divisor = TIMESTAMP_FORMATS[fmt]
+
+    # reject values outside of what 'datetime' can represent before
+    # scaling them so the arithmetic can't overflow
+    low = -((offset - DATETIME_MIN_US) * divisor // multiplier)
+    high = (DATETIME_MAX_US - offset) * divisor // multiplier
+    if values.dtype.kind != 'f':
+        low = max(low, np.iinfo(np.int64).min)
+        high = min(high, np.iinfo(np.int64).max)
+    valid = (values >= low) & (values <= high)
+    values = np.where(valid, values, 0)
+
+    if values.dtype.kind == 'f':
+        us = np.floor(values * multiplier / divisor).astype(np.int64) + offset
+    else:
+        us = values * multiplier // divisor + offset
+
+    if fmt == 'gps':
+        # leap second n takes effect once n - 1 earlier ones have elapsed
+        leaps = np.array(GPS_LEAP_SECONDS, dtype='datetime64[us]').astype(np.int64)
+        leaps += np.arange(1, len(leaps) + 1) * 1000000
+        us -= np.searchsorted(leaps, us, side='right') * 1000000
+
+    valid &= (us >= DATETIME_MIN_US) & (us <= DATETIME_MAX_US)
+    return np.where(valid, us, 0), valid
+
+
+def detect_timestamp_format(values, formats=AUTO_FORMATS):
+    """Guess the format of a column of timestamps.  The format that decodes
+       the most non-zero values to a plausible time wins and ties go to the
+       format whose median time is closest to now."""
+    values = values[values != 0]
+    if not len(values):
+        return formats[0]
+
+    now = int(time.time() * 1000000)
+    best = None
+    for fmt in formats:
+        us, valid = decode_timestamps(values, fmt)
+        plausible = valid & (us >= PLAUSIBLE_MIN_US) & \
+            (us <= now + PLAUSIBLE_FUTURE_US)
+        if plausible.any():
+            distance = abs(int(np.median(us[plausible])) - now)
+        else:
+            distance = 0
+        score = (np.count_nonzero(plausible), -distance)
+        if best is None or score > best[0]:
+            best = (score, fmt)
+    return best[1]
+
+
+def parse_timestamps(strings):
+    """Parse timestamp strings to an int64 array, or float64 if needed"""
+    try:
+        return np.array(strings, dtype=np.int64)
+    except (ValueError, OverflowError):
+        return np.array(strings, dtype=np.float64)
+
+
+def parse_sqlite_values(values):
+    """Convert SQLite column values to an int64 array, or float64 if any of
+       them are REAL.  TEXT values are parsed like timestamp strings."""
+    if any(isinstance(value, str) for value in values):
+        return parse_timestamps([str(value) for value in values])
+    if any(isinstance(value, float) for value in values):
+        return np.array(values, dtype=np.float64)
+    return np.array(values, dtype=np.int64)
+
+
+def convert_timestamps(values, fmt):
+    """Convert an array of timestamps in the given format to arrays of
+       localtime and UTC time strings"""
+    utc_us, utc_valid = decode_timestamps(values, fmt)
+    offsets, local_valid = localtime_offsets(utc_us)
+    local_us = utc_us + offsets
+    local_valid &= utc_valid & (local_us >= DATETIME_MIN_US) & \
+        (local_us <= DATETIME_MAX_US)
+    # keep the scalar behaviour where either failure invalidates both times
+    utc_valid &= local_valid
+    return format_datetime64(local_us, local_valid), \
+        format_datetime64(utc_us, utc_valid)
+
+
+def convert_timestamps_batch(columns, formats):
+    """Convert columns of timestamp strings in the given formats to a block
+       of CSV lines of timestamp, localtime and UTC time for each column"""
+    lines = None
+    for strings, fmt in zip(columns, formats):
+        localtimes, utctimes = convert_timestamps(parse_timestamps(strings), fmt)
+        column = np.char.add(np.asarray(strings, dtype=str), ', ')
+        column = np.char.add(column, localtimes)
+        column = np.char.add(column, ', ')
+        column = np.char.add(column, utctimes)
+        lines = column if lines is None else \
+            np.char.add(np.char.add(lines, ', '), column)
+    return '\n'.join(lines.tolist()) + '\n'
+
+
+def read_timestamp_chunks(lines, ncolumns, chunksize=CHUNK_SIZE):
+    """Yield lists of ncolumns columns of up to chunksize timestamp strings
+       from an iterable of comma separated lines"""
+    while True:
+        chunk = ''.join(itertools.islice(lines, chunksize))
+        if ncolumns == 1:
+            rows = chunk.split()
+            if not rows:
+                return
+            yield [rows]
+            continue
+        rows = [line.split(',') for line in chunk.splitlines() if line.strip()]
+        if not rows:
+            return
+        for row in rows:
+            if len(row) != ncolumns:
+                raise ValueError("Expected %i columns but found %i: %s"
+                                 % (ncolumns, len(row), ','.join(row)))
+        yield [[value.strip() for value in column] for column in zip(*rows)]
+
+
+def quote_identifier(name):
+    """Quote an SQLite table or column name"""
+    return '"%s"' % name.replace('"', '""')
+
+
+def sqlite_column_names(key, columns):
+    """Return the output column names for convert_sqlite()"""
+    names = [key]
+    for column in columns:
+        names.extend((column, column + '_localtime', column + '_utctime'))
+    return names
+
+
+def convert_sqlite(database, table, columns, formats, key='rowid',
+                   chunksize=CHUNK_SIZE):
+    """Read the key and timestamp columns from an SQLite table in chunks and
+       yield lists of converted rows of key, then timestamp, localtime and
+       UTC time for each column.  NULL timestamps are passed through."""
+    formats = list(formats)
+    uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(database))
+    db = sqlite3.connect(uri, uri=True)
+    try:
+        cursor = db.execute('SELECT %s FROM %s' % (
+            ', '.join(quote_identifier(c) for c in [key] + columns),
+            quote_identifier(table)))
+
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                return
+            keys, *rowcolumns = zip(*rows)
+
+            converted = [keys]
+            for index, values in enumerate(rowcolumns):
+                nulls = np.array([value is None for value in values])
+                timestamps = parse_sqlite_values(
+                    [0 if value is None else value for value in values])
+
+                # auto-detect the format of each column from its first chunk
+                # with non-NULL, non-zero values, all NULL chunks decide nothing
+                fmt = formats[index]
+                if fmt == 'auto':
+                    fmt = detect_timestamp_format(timestamps[~nulls])
+                    if np.count_nonzero(timestamps[~nulls]):
+                        formats[index] = fmt
+
+                localtimes, utctimes = convert_timestamps(timestamps, fmt)
+                localtimes = localtimes.astype(object)
+                utctimes = utctimes.astype(object)
+                localtimes[nulls] = None
+                utctimes[nulls] = None
+                converted.extend((values, localtimes.tolist(), utctimes.tolist()))
+            yield list(zip(*converted))
+    finally:
+        db.close()
+
+
 def main():
     # setup the argument parser for the command line arguments
     parser = argparse.ArgumentParser(
         prog='convert-prtime.py',
         description='Convert PRTime to something usable (CSV Output)')
 
-    parser.add_argument('-t', metavar='prtime', nargs='+', type=int,
+    parser.add_argument('-t', metavar='prtime', nargs='+',
                         help='PRTime (ie. 1306678742795922)')
     parser.add_argument('-i', metavar='input_file',
                         type=argparse.FileType('rt'),
                         help='Read PRTimes from a file, one PRTime per line')
+    parser.add_argument('-b', action='store_true',
+                        help='Batch mode, convert in chunks using NumPy')
+    parser.add_argument('-c', metavar='chunk_size', type=int, default=CHUNK_SIZE,
+                        help='PRTimes per chunk in batch mode (default: %(default)s)')
+    parser.add_argument('-f', metavar='format', nargs='+', default=['prtime'],
+                        choices=sorted(TIMESTAMP_FORMATS) + ['auto'],
+                        help='Timestamp format of each input column, implies '
+                             'batch mode (default: prtime, choices: %(choices)s)')
+    parser.add_argument('-d', metavar='database',
+                        help='Convert columns of an SQLite database (read-only)')
+    parser.add_argument('-T', metavar='table',
+                        help='Table to read from the SQLite database')
+    parser.add_argument('-C', metavar='column', nargs='+',
+                        help='Timestamp columns to convert from the SQLite table')
+    parser.add_argument('-k', metavar='key', default='rowid',
+                        help='Key column to keep with each row (default: %(default)s)')
+    parser.add_argument('-o', metavar='output_database',
+                        help='Write SQLite rows to a new table in this database '
+                             'instead of CSV')
+    parser.add_argument('-n', metavar='output_table',
+                        help='Output table name (default: <table>_converted)')
     parser.add_argument('-v', action='version',
                         version='%(prog)s 0.1', help='Version')
     args = parser.parse_args()
@@ -49,29 +362,89 @@ def main():
         parser.print_help()
         return
 
-    # holds orginal prtime and converted prtimes
-    converted_prtimes = []
+    # convert columns straight out of an SQLite database
+    if args.d:
+        if np is None:
+            sys.exit("SQLite mode requires NumPy.  Exiting.")
+        if not args.T or not args.C:
+            sys.exit("SQLite mode requires a table ('-T') and columns ('-C').  Exiting.")
+        if len(args.f) == 1:
+            args.f = args.f * len(args.C)
+        elif len(args.f) != len(args.C):
+            sys.exit("Specify one format or one format per column.  Exiting.")
+        if not os.path.isfile(args.d):
+            sys.exit("SQLite database '%s' does not exist.  Exiting." % args.d)
+
+        names = sqlite_column_names(args.k, args.C)
+        chunks = convert_sqlite(args.d, args.T, args.C, args.f, args.k, args.c)
+        try:
+            if args.o:
+                table = quote_identifier(args.n or args.T + '_converted')
+                db = sqlite3.connect(args.o)
+                db.execute('CREATE TABLE %s (%s)' % (
+                    table, ', '.join(quote_identifier(n) for n in names)))
+                for rows in chunks:
+                    db.executemany('INSERT INTO %s VALUES (%s)' % (
+                        table, ', '.join('?' * len(names))), rows)
+                    db.commit()
+                db.close()
+            else:
+                writer = csv.writer(sys.stdout, lineterminator='\n')
+                writer.writerow(names)
+                for rows in chunks:
+                    writer.writerows(rows)
+        except sqlite3.Error as e:
+            sys.exit("({})".format(e))
+        return
+
+    # formats other than a single PRTime column are decoded in batch mode
+    if args.f != ['prtime']:
+        args.b = True
+
+    # convert in chunks with NumPy and stream the results as CSV
+    if args.b:
+        if np is None:
+            sys.exit("Batch mode requires NumPy.  Exiting.")
+        chunks = []
+        if args.t:
+            chunks.append([args.t])
+            if len(args.f) != 1:
+                sys.exit("Only one format can be used with '-t'.  Exiting.")
+        if args.i:
+            chunks = itertools.chain(chunks,
+                                     read_timestamp_chunks(args.i, len(args.f), args.c))
+
+        formats = None
+        for columns in chunks:
+            # auto-detect formats from the first chunk of each column
+            if formats is None:
+                formats = [detect_timestamp_format(parse_timestamps(column))
+                           if fmt == 'auto' else fmt
+                           for column, fmt in zip(columns, args.f)]
+                print(', '.join(', '.join((fmt, 'localtime', 'utctime'))
+                                for fmt in formats))
+            sys.stdout.write(convert_timestamps_batch(columns, formats))
+        return
+
+    # '-t' prtime arguments are whole microseconds outside of batch mode
+    prtimes = []
+    for prtime in args.t or []:
+        try:
+            prtimes.append(int(prtime))
+        except ValueError:
+            parser.error("argument -t: invalid int value: '%s'" % prtime)
+
+    # print out the original and converted prtimes in CSV as they are converted
+    print(', '.join(('prtime', 'localtime', 'utctime')))
 
     # process '-t' prtime arguments
-    if args.t:
-        for prtime in args.t:
-            try:
-                converted_prtimes.append(convert_prtime(prtime))
-            except:
-                raise
+    for prtime in prtimes:
+        print(convert_prtime(prtime))
 
     # process lines from input file
     if args.i:
         for line in args.i:
-            try:
-                converted_prtimes.append(convert_prtime(int(line)))
-            except:
-                raise
-
-    # print out the original and converted prtimes in CSV
-    print(', '.join(('prtime', 'localtime', 'utctime')))
-    for item in converted_prtimes:
-        print(item)
+            print(convert_prtime(int(line)))
 
 
 if __name__ == "__main__":
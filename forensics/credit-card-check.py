@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 #
 # Test a number to see if it passes the Luhn check for credit
 # card validity.  Beware false positives.  Beware I say!
@@ -6,23 +6,84 @@
 # Author: Derrick Karpo
 # Date:   February 26, 2009
 #
+# Notes:
+# o Scan mode ('-s') carves card numbers out of raw disk images and other
+#   large files.  The file is memory-mapped and split into overlapping
+#   chunks across a process pool.  Candidate runs of 13-19 digits, plain or
+#   space/dash separated, that pass the Luhn check are output with their
+#   byte offset and a masked number (ie. -s image.dd -j 8).
+# o Batch mode ('-i') checks one number per line from a file or stdin with
+#   a vectorized Luhn check.  It requires NumPy, which is also used to
+#   speed up the Luhn checks in scan mode if available.
+#   - $ sudo apt-get install python3-numpy
+# o An IIN/BIN range table ('-b') classifies each Luhn valid number by
+#   issuer and drops numbers with an unknown prefix or an invalid length
+#   for their issuer.  The table is a CSV of prefix or prefix range,
+#   issuer and card lengths, the most specific prefix wins.  ie.
+#     4,Visa,13;16;19
+#     34-37,American Express,15
+#     2221-2720,Mastercard,16
+#     622126-622925,Discover,16-19
+#
 
+import re
+import os
+import csv
 import sys
+import mmap
+import itertools
+import multiprocessing
 
 try:
     from optparse import OptionParser
 except ImportError:
-    raise ImportError, 'This program requires the OptionParser extensions for Python.'
+    raise ImportError('This program requires the OptionParser extensions for Python.')
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# 13-19 digits either contiguous or in 4-4-4-4(-x) and 4-6-5 style groups
+CARD_PATTERN = re.compile(rb'(?<![0-9])(?:[0-9]{13,19}'
+                          rb'|[0-9]{4}(?:[ -][0-9]{4}){2,3}(?:[ -][0-9]{1,3})?'
+                          rb'|[0-9]{4}[ -][0-9]{6}[ -][0-9]{4,5})(?![0-9])')
+SEPARATORS = re.compile(rb'[ -]')
+
+# scan chunks overlap by more than the longest possible match
+CHUNK_SIZE = 64 * 1024 * 1024
+CHUNK_OVERLAP = 64
+
+# numbers checked per batch in batch mode
+BATCH_SIZE = 1000000
+
+# the Luhn value of each doubled digit
+LUHN_DOUBLED = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
 
 
 def parseOptions():
     if len(sys.argv) == 1:
         sys.argv.append('-h')
 
-    usage = "usage: %prog card# ..."
+    usage = "usage: %prog card# ...\n" \
+            "       %prog -i FILE\n" \
+            "       %prog -s FILE [-j JOBS]"
     description = "Test a credit card number against the Luhn algorithm"
 
     parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-i", action="store", dest="infile", metavar="FILE",
+                      help="Check one card number per line from FILE ('-' for stdin).")
+    parser.add_option("-s", action="store", dest="scanfile", metavar="FILE",
+                      help="Scan FILE (ie. a disk image) for card numbers.")
+    parser.add_option("-b", action="store", dest="iinfile", metavar="FILE",
+                      help="Classify card numbers with the IIN/BIN range table FILE.")
+    parser.add_option("-j", action="store", type="int", dest="jobs",
+                      default=os.cpu_count(), metavar="JOBS",
+                      help="Number of scanning processes (default: %default).")
+    parser.add_option("-c", action="store", type="int", dest="chunksize",
+                      default=CHUNK_SIZE // (1024 * 1024), metavar="MB",
+                      help="Scan chunk size in megabytes (default: %default).")
     (opts, args) = parser.parse_args()
     return (opts, args)
 
@@ -46,17 +107,222 @@ def cardLuhnChecksumIsValid(card_number):
     return ((sum % 10) == 0)
 
 
+def luhnDigitMatrixIsValid(digits):
+    """ checks a matrix of card numbers of the same length, one digit per
+        column, and returns a boolean array of luhn mod-10 checksum results """
+    digits = np.asarray(digits, dtype=np.uint8)
+    doubled = (np.arange(digits.shape[1])[::-1] & 1).astype(bool)
+    total = digits[:, ~doubled].sum(axis=1, dtype=np.int64) + \
+        np.array(LUHN_DOUBLED, dtype=np.uint8)[digits[:, doubled]].sum(axis=1, dtype=np.int64)
+    return (total % 10) == 0
+
+
+def cardLuhnChecksumsAreValid(card_numbers):
+    """ checks a batch of card number strings and returns a boolean array of
+        luhn mod-10 checksum results, numbers that aren't all digits fail """
+    cards = np.asarray(card_numbers)
+    try:
+        cards = cards.astype(bytes)
+    except UnicodeEncodeError:
+        cards = np.char.encode(cards, 'ascii', 'replace')
+    results = np.zeros(len(cards), dtype=bool)
+    lengths = np.char.str_len(cards)
+
+    # group the numbers by length into digit matrices
+    for length in np.unique(lengths):
+        if length == 0:
+            continue
+        group = np.nonzero(lengths == length)[0]
+        digits = np.frombuffer(cards[group].astype('S%i' % length).tobytes(),
+                               dtype=np.uint8).reshape(-1, length) - ord('0')
+        isdigits = (digits <= 9).all(axis=1)
+        results[group] = isdigits & luhnDigitMatrixIsValid(np.where(digits <= 9, digits, 0))
+    return results
+
+
+def rangeToPrefixes(low, high):
+    """Split an inclusive range of equal length digit strings into the
+       fewest prefixes that cover it, ie. 2221-2720 to 2221...2229, 223...
+       229, 23...26, 270...271, 2720"""
+    width = len(low)
+    low, high = int(low), int(high)
+    prefixes = []
+    while low <= high:
+        digits = 0
+        while digits < width and low % 10 ** (digits + 1) == 0 and \
+                low + 10 ** (digits + 1) - 1 <= high:
+            digits += 1
+        prefixes.append(str(low).zfill(width)[:width - digits])
+        low += 10 ** digits
+    return prefixes
+
+
+def parseCardLengths(lengths):
+    """Parse card lengths like '13;16-19' to a frozenset of lengths"""
+    result = set()
+    for item in lengths.split(';'):
+        first, _, last = item.strip().partition('-')
+        result.update(range(int(first), int(last or first) + 1))
+    return frozenset(result)
+
+
+def loadIINTable(filename):
+    """Build a prefix trie of nested dicts keyed by digit from an IIN/BIN
+       range table, each prefix's (issuer, lengths) is stored under ''"""
+    trie = {}
+    with open(filename, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0].lstrip().startswith('#'):
+                continue
+            try:
+                prefix, issuer, lengths = (field.strip() for field in row)
+                low, _, high = prefix.partition('-')
+                if not (low + high).isdigit() or (high and len(high) != len(low)):
+                    raise ValueError(prefix)
+                entry = (issuer, parseCardLengths(lengths))
+            except ValueError:
+                raise ValueError("Invalid IIN table row: %s" % ','.join(row))
+
+            for prefix in rangeToPrefixes(low, high or low):
+                node = trie
+                for digit in prefix:
+                    node = node.setdefault(digit, {})
+                node[''] = entry
+    return trie
+
+
+def classifyCardNumber(trie, card_number):
+    """Return the issuer of the most specific prefix of a card number from an
+       IIN trie, or None if no prefix matches or the length is invalid"""
+    entry = None
+    node = trie
+    for digit in card_number:
+        node = node.get(digit)
+        if node is None:
+            break
+        entry = node.get('', entry)
+    if entry is None or len(card_number) not in entry[1]:
+        return None
+    return entry[0]
+
+
+def maskCardNumber(card_number):
+    """Mask all but the first six and last four digits of a card number"""
+    return card_number[:6] + '*' * (len(card_number) - 10) + card_number[-4:]
+
+
+# the IIN trie used by each scanning process, set by setIINTrie()
+iinTrie = None
+
+
+def setIINTrie(trie):
+    global iinTrie
+    iinTrie = trie
+
+
+def scanChunk(job):
+    """Return (offset, card number, issuer) for each Luhn valid candidate
+       that starts within a chunk of a file.  With an IIN trie candidates
+       with an unknown prefix or invalid length are dropped."""
+    filename, start, size = job
+    candidates = []
+    with open(filename, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # the lookbehind can see before 'start' and the overlap lets a match
+        # that starts in this chunk run past its end
+        end = min(start + size + CHUNK_OVERLAP, len(mm))
+        for match in CARD_PATTERN.finditer(mm, start, end):
+            if match.start() >= start + size:
+                break
+            card = SEPARATORS.sub(b'', match.group()).decode()
+            if 13 <= len(card) <= 19:
+                candidates.append((match.start(), card))
+
+    if np is not None and candidates:
+        valid = cardLuhnChecksumsAreValid([card for offset, card in candidates])
+        candidates = list(itertools.compress(candidates, valid))
+    else:
+        candidates = [(offset, card) for offset, card in candidates
+                      if cardLuhnChecksumIsValid(card)]
+
+    if iinTrie is None:
+        return [(offset, card, None) for offset, card in candidates]
+    results = []
+    for offset, card in candidates:
+        issuer = classifyCardNumber(iinTrie, card)
+        if issuer is not None:
+            results.append((offset, card, issuer))
+    return results
+
+
+def scanFile(filename, jobs, chunksize=CHUNK_SIZE, trie=None):
+    """Yield (offset, card number, issuer) for card numbers in a file in
+       order, the issuer is None without an IIN trie"""
+    filesize = os.path.getsize(filename)
+    if not filesize:
+        return
+    chunks = [(filename, start, chunksize)
+              for start in range(0, filesize, chunksize)]
+    with multiprocessing.Pool(jobs, setIINTrie, (trie,)) as pool:
+        for results in pool.imap(scanChunk, chunks):
+            yield from results
+
+
 def main():
     """Runs program and handles command line options"""
 
     # read command line options
     (opts, args) = parseOptions()
 
+    # load the IIN/BIN range table
+    trie = None
+    if opts.iinfile:
+        try:
+            trie = loadIINTable(opts.iinfile)
+        except (IOError, OSError, ValueError) as e:
+            sys.exit("({})".format(e))
+
+    def formatResult(card, result):
+        """Format a card number check, adding the issuer with an IIN table"""
+        if trie is None:
+            return "%s %s" % (card, result)
+        issuer = classifyCardNumber(trie, card) if result else None
+        return "%s %s %s" % (card, result and issuer is not None, issuer or 'unknown')
+
+    # scan a file and stream the offsets and masked card numbers
+    if opts.scanfile:
+        try:
+            for offset, card, issuer in scanFile(opts.scanfile, opts.jobs,
+                                                 opts.chunksize * 1024 * 1024, trie):
+                if issuer is None:
+                    print("%i %s" % (offset, maskCardNumber(card)))
+                else:
+                    print("%i %s %s" % (offset, maskCardNumber(card), issuer))
+        except (IOError, OSError) as e:
+            sys.exit("({})".format(e))
+        return
+
+    # test the card numbers from a file in batches
+    if opts.infile:
+        if np is None:
+            sys.exit("Batch mode requires NumPy.")
+        try:
+            infile = sys.stdin.buffer if opts.infile == '-' else open(opts.infile, 'rb')
+            while True:
+                cards = [line.strip() for line in itertools.islice(infile, BATCH_SIZE)]
+                if not cards:
+                    break
+                results = cardLuhnChecksumsAreValid(cards)
+                sys.stdout.write(''.join(formatResult(card.decode(errors='replace'), result) + '\n'
+                                         for card, result in zip(cards, results.tolist())))
+        except (IOError, OSError) as e:
+            sys.exit("({})".format(e))
+        return
+
     # test the card number
-    for card in sys.argv[1:]:
+    for card in args:
         result = cardLuhnChecksumIsValid(card)
-        print "%s %s" % (card,result)
-
+        print(formatResult(card, result))
 
 if __name__ == "__main__":
     main()
@@ -1,72 +1,257 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 #
 # Calculate the delta between two dates and/or times.
 #
 # Author: Derrick Karpo
 # Date:   August 29, 2008
 #
+# Notes:
+# o Bulk mode ('-i') reads a timeline CSV (ie. a log2timeline supertimeline)
+#   and streams the delta between consecutive events, or between two
+#   columns of each event, flagging gaps over a threshold.  It requires
+#   NumPy.
+#   - $ sudo apt-get install python3-numpy
+# o Bulk timestamps may be '%m/%d/%Y %H:%M:%S' or ISO 8601 (UTC).  The
+#   timestamp can be built from separate date and time columns, ie.
+#   -i timeline.csv -c date time -g 3600
+#
 
 import re
+import csv
 import sys
 import time
+import itertools
 from datetime import datetime
 
 try:
     from optparse import OptionParser
 except ImportError:
-    raise ImportError, 'This program requires the OptionParser extension for Python.'
+    raise ImportError('This program requires the OptionParser extension for Python.')
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# date format of the two command line dates and the default bulk format
+DATE_FORMAT = '%m/%d/%Y %H:%M:%S'
+DATE_PATTERN = re.compile(r"\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}")
+
+# byte positions that rearrange 'MM/DD/YYYY HH:MM:SS' to 'YYYY-MM-DDTHH:MM:SS'
+DATE_TO_ISO = [6, 7, 8, 9, 2, 0, 1, 5, 3, 4, 10, 11, 12, 13, 14, 15, 16, 17, 18]
+
+# number of timeline rows processed per chunk in bulk mode
+CHUNK_SIZE = 500000
 
 
 def parseOptions():
     if len(sys.argv) == 1:
         sys.argv.append('-h')
 
-    usage = "usage: %prog 'date1' 'date2' (date format is '%m/%d/%Y %H:%M:%S')"
+    usage = "usage: %prog 'date1' 'date2' (date format is '%m/%d/%Y %H:%M:%S')\n" \
+            "       %prog -i timeline.csv -c column [column] [-e column] [-g seconds]"
     description = "Determine the delta between two dates/time."
 
     parser = OptionParser(usage=usage, description=description)
     parser.add_option("-d", action="store_true", dest="debug",
                       help="Run the script with debug values for testing.")
+    parser.add_option("-i", action="store", dest="infile", metavar="FILE",
+                      help="Bulk mode, read a timeline CSV from FILE ('-' for stdin).")
+    parser.add_option("-c", action="store", dest="column", metavar="COLUMN",
+                      help="Timestamp column name or number.  A second column "
+                           "after the first (ie. -c date time) is joined to it.")
+    parser.add_option("-e", action="store", dest="endcolumn", metavar="COLUMN",
+                      help="Calculate the delta to this column of each row "
+                           "instead of to the next row.")
+    parser.add_option("-g", action="store", type="float", dest="gap",
+                      metavar="SECONDS",
+                      help="Flag deltas larger than SECONDS as gaps.")
+    parser.add_option("-G", action="store_true", dest="gapsonly",
+                      help="Only output the gaps.")
+    parser.add_option("-s", action="store", type="int", dest="chunksize",
+                      default=CHUNK_SIZE, metavar="ROWS",
+                      help="Rows per chunk in bulk mode (default: %default).")
     (opts, args) = parser.parse_args()
+
+    # allow '-c date time'
+    if opts.column and args and opts.infile:
+        opts.column = [opts.column, args.pop(0)]
+    elif opts.column:
+        opts.column = [opts.column]
     return (opts, args)
 
 
+def parseTimestamps(strings):
+    """Parse an array of timestamp strings to datetime64[us], NaT if invalid"""
+    strings = np.char.strip(np.asarray(strings, dtype=str))
+
+    # rearrange fixed width '%m/%d/%Y %H:%M:%S' dates to ISO 8601 bytes
+    dates = np.char.count(strings, '/') == 2
+    lengths = np.char.str_len(strings)
+    exact = dates & (lengths == 19)
+    if exact.any():
+        raw = strings[exact].astype('S19')
+        raw = raw.view(np.uint8).reshape(-1, 19)[:, DATE_TO_ISO]
+        raw[:, [4, 7]] = ord('-')
+        raw[:, 10] = ord('T')
+        strings[exact] = np.ascontiguousarray(raw).view('S19').ravel().astype(str)
+
+    # keep the fraction of dates with fractional seconds
+    fractional = dates & (lengths > 19)
+    if fractional.any():
+        strings[fractional] = [s[6:10] + '-' + s[:2] + '-' + s[3:5] + 'T' + s[11:]
+                               for s in strings[fractional].tolist()]
+
+    # numpy only parses naive times, drop a UTC designator
+    strings = np.char.replace(np.char.replace(strings, '+00:00', ''), 'Z', '')
+    try:
+        return strings.astype('datetime64[us]')
+    except ValueError:
+        pass
+
+    # fall back to one at a time to find the bad timestamps
+    timestamps = np.empty(len(strings), dtype='datetime64[us]')
+    for index, string in enumerate(strings.tolist()):
+        try:
+            timestamps[index] = np.datetime64(string, 'us')
+        except ValueError:
+            timestamps[index] = np.datetime64('NaT')
+    return timestamps
+
+
+def findColumn(header, column):
+    """Return the index of a column given by name or number"""
+    if column in header:
+        return header.index(column)
+    try:
+        return int(column)
+    except ValueError:
+        sys.exit("Column '%s' is not in the header." % column)
+
+
+def readTimelineChunks(reader, columns, endcolumn, chunksize):
+    """Yield (row numbers, start timestamps, end timestamps) for chunks of
+       timeline rows, end timestamps are None without an end column"""
+    rownumber = 1
+    while True:
+        rows = list(itertools.islice(reader, chunksize))
+        if not rows:
+            return
+        try:
+            start = [' '.join(row[c] for c in columns) for row in rows]
+            end = [row[endcolumn] for row in rows] if endcolumn is not None else None
+        except IndexError:
+            sys.exit("Row %i is missing a timestamp column." % rownumber)
+
+        numbers = np.arange(rownumber, rownumber + len(rows))
+        rownumber += len(rows)
+        yield numbers, parseTimestamps(start), \
+            parseTimestamps(end) if end is not None else None
+
+
+def formatTimestamps(timestamps):
+    """Format datetime64 timestamps as 'YYYY-MM-DD HH:MM:SS.ffffff'"""
+    strings = np.char.replace(np.datetime_as_string(timestamps, unit='us'), 'T', ' ')
+    strings[np.isnat(timestamps)] = 'invalid'
+    return strings
+
+
+def bulkDeltas(opts):
+    """Stream the timeline deltas and gaps as CSV"""
+    if np is None:
+        sys.exit("Bulk mode requires NumPy.")
+    if not opts.column:
+        sys.exit("Bulk mode requires a timestamp column ('-c').")
+
+    infile = sys.stdin if opts.infile == '-' else open(opts.infile, newline='')
+    reader = csv.reader(infile)
+    header = next(reader, [])
+    columns = [findColumn(header, c) for c in opts.column]
+    endcolumn = findColumn(header, opts.endcolumn) if opts.endcolumn else None
+    gap = np.timedelta64(int(opts.gap * 1000000), 'us') if opts.gap is not None else None
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    if endcolumn is None:
+        writer.writerow(('row', 'timestamp', 'delta_seconds', 'gap'))
+    else:
+        writer.writerow(('row', 'start', 'end', 'delta_seconds', 'gap'))
+
+    # the last valid event so far, consecutive deltas skip invalid events
+    # and span chunks
+    previous = np.array(['NaT'], dtype='datetime64[us]')
+    for numbers, start, end in readTimelineChunks(reader, columns, endcolumn,
+                                                  opts.chunksize):
+        if end is None:
+            events = np.concatenate((previous, start))
+            last = np.where(np.isnat(events), 0, np.arange(len(events)))
+            last = events[np.maximum.accumulate(last)]
+            deltas = start - last[:-1]
+            previous = last[-1:]
+        else:
+            deltas = end - start
+
+        valid = ~np.isnat(deltas)
+        gaps = valid & (np.abs(deltas) > gap) if gap is not None else \
+            np.zeros(len(deltas), dtype=bool)
+        if opts.gapsonly:
+            keep = gaps
+            numbers, start, deltas, gaps, valid = \
+                numbers[keep], start[keep], deltas[keep], gaps[keep], valid[keep]
+            end = end[keep] if end is not None else None
+            if not len(numbers):
+                continue
+
+        seconds = (deltas.astype(np.int64) / 1e6).astype(str)
+        seconds[~valid] = ''
+        output = [numbers.astype(str), formatTimestamps(start)]
+        if end is not None:
+            output.append(formatTimestamps(end))
+        output.extend((seconds, np.where(gaps, 'gap', '')))
+        writer.writerows(zip(*(column.tolist() for column in output)))
+
+    if infile is not sys.stdin:
+        infile.close()
+
+
 def main():
     # read command line options
     (opts, args) = parseOptions()
 
+    if opts.infile:
+        bulkDeltas(opts)
+        return
+
     if opts.debug:
         # sample data
         date1 = '01/01/2008 18:20:20'
         date2 = '01/02/2008 19:40:40'
-        print "Using sample data %s and %s." % (date1, date2)
+        print("Using sample data %s and %s." % (date1, date2))
     else:
         date1 = sys.argv[1]
         date2 = sys.argv[2]
 
     for date in date1, date2:
-        pattern = re.compile("\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}")
-        match = pattern.search(date)
+        match = DATE_PATTERN.search(date)
 
         if match:
             continue
         else:
-            print "Date %s is not in format '%%m/%%d/%%Y %%H:%%M:%%S' " \
-                  "ie. '01/01/2008 15:20:20'" % date
+            print("Date %s is not in format '%%m/%%d/%%Y %%H:%%M:%%S' "
+                  "ie. '01/01/2008 15:20:20'" % date)
             exit(1)
 
-    pattern = '%m/%d/%Y %H:%M:%S'
-    t1 = datetime.strptime(date1, pattern)
-    t2 = datetime.strptime(date2, pattern)
+    t1 = datetime.strptime(date1, DATE_FORMAT)
+    t2 = datetime.strptime(date2, DATE_FORMAT)
     s1 = time.mktime(t1.timetuple())
     s2 = time.mktime(t2.timetuple())
 
     diff = t2 - t1
     weeks, days = divmod(diff.days, 7)
 
-    print '%i seconds' % (s2 - s1)
-    print '%s hours.' % diff
-    print '%i weeks and %i days.' % (weeks, days)
+    print('%i seconds' % (s2 - s1))
+    print('%s hours.' % diff)
+    print('%i weeks and %i days.' % (weeks, days))
 
 
 if __name__ == "__main__":
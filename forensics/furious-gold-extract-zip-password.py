@@ -5,37 +5,294 @@
 # Author: Derrick Karpo
 # Date:   May 4, 2016
 #
+# Notes:
+# o Only the zip end of central directory record at the end of each dump
+#   is read to get the archive comment, so multi-GB dumps are handled in
+#   a couple of small reads.
+# o Batch mode ('-d') extracts the passwords for every dump in a directory
+#   concurrently and outputs a CSV of archive and password.
+# o The password can be verified ('-v') against the encryption header of
+#   the smallest encrypted entry in the archive (the ZipCrypto check byte
+#   or the WinZip AES password verifier) instead of extracting the dump.
+#   Small ZipCrypto entries are also decrypted and CRC checked since the
+#   check byte alone passes 1 in 256 wrong passwords.
+#
 
+import os
 import sys
 import re
-import zipfile
+import csv
+import zlib
+import struct
 import hashlib
 import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+# look for Rid (from Android dumps) or IMEI (from MTK devices)
+RID_PATTERN = re.compile(r'Rid: (\w+)')
+IMEI_PATTERN = re.compile(r'IMEI1 [OTP]: (\w+)')
+
+# zip end of central directory record, the comment can be up to 64 KiB
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD_SIZE = 22
+EOCD_MAX_COMMENT = 0xFFFF
+EOCD_FORMAT = '<4s4H2LH'
+
+# zip64 end of central directory locator and record
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_LOCATOR_FORMAT = '<4sLQL'
+ZIP64_EOCD_SIGNATURE = b'PK\x06\x06'
+ZIP64_EOCD_FORMAT = '<4sQ2H2L4Q'
+
+# central directory and local file headers
+CENTRAL_SIGNATURE = b'PK\x01\x02'
+CENTRAL_FORMAT = '<4s6H3L5H2L'
+LOCAL_SIGNATURE = b'PK\x03\x04'
+LOCAL_FORMAT = '<4s5H3L2H'
+
+# general purpose flags, compression methods and extra field ids
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+METHOD_AES = 99
+EXTRA_ZIP64 = 0x0001
+EXTRA_AES = 0x9901
+
+# WinZip AES salt and key lengths by strength
+AES_SALT_LENGTHS = {1: 8, 2: 12, 3: 16}
+AES_KEY_LENGTHS = {1: 16, 2: 24, 3: 32}
+AES_ITERATIONS = 1000
+
+# ZipCrypto entries up to this size are fully decrypted and CRC checked
+ZIPCRYPTO_CRC_CHECK_SIZE = 64 * 1024
+ZIPCRYPTO_HEADER_SIZE = 12
+
+
+def generateCRCTable():
+    """Generate the CRC-32 table used by the ZipCrypto keys"""
+    table = []
+    for crc in range(256):
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xEDB88320 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = generateCRCTable()
+
+
+def readEndOfCentralDirectory(f):
+    """Return the offset of the end of central directory record in an open
+       archive and the record and comment bytes"""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    tail = min(size, EOCD_SIZE + EOCD_MAX_COMMENT)
+    f.seek(size - tail)
+    data = f.read(tail)
+
+    # the record is the last signature whose comment runs to the end of file
+    pos = data.rfind(EOCD_SIGNATURE)
+    while pos >= 0:
+        commentLength = struct.unpack('<H', data[pos + 20:pos + 22])[0]
+        if pos + EOCD_SIZE + commentLength == len(data):
+            return size - tail + pos, data[pos:]
+        pos = data.rfind(EOCD_SIGNATURE, 0, pos)
+    raise ValueError("'%s' is not a zip archive" % f.name)
+
+
+def readZipComment(archive):
+    """Read the zip archive comment from the end of central directory record"""
+    with open(archive, 'rb') as f:
+        offset, record = readEndOfCentralDirectory(f)
+    return record[EOCD_SIZE:]
+
+
+def readCentralDirectory(f):
+    """Yield (flags, method, modified time, CRC, compressed size, local
+       header offset, extra field) for each entry of an open archive"""
+    offset, record = readEndOfCentralDirectory(f)
+    (_, _, _, _, entries, cdSize, cdOffset, _) = \
+        struct.unpack(EOCD_FORMAT, record[:EOCD_SIZE])
+
+    # zip64 archives keep the real central directory size and offset in the
+    # zip64 end of central directory record
+    if cdOffset == 0xFFFFFFFF or cdSize == 0xFFFFFFFF or entries == 0xFFFF:
+        locatorSize = struct.calcsize(ZIP64_LOCATOR_FORMAT)
+        f.seek(offset - locatorSize)
+        locator = struct.unpack(ZIP64_LOCATOR_FORMAT, f.read(locatorSize))
+        if locator[0] != ZIP64_LOCATOR_SIGNATURE:
+            raise ValueError("'%s' has a corrupt zip64 locator" % f.name)
+        f.seek(locator[2])
+        zip64 = f.read(struct.calcsize(ZIP64_EOCD_FORMAT))
+        zip64 = struct.unpack(ZIP64_EOCD_FORMAT, zip64)
+        if zip64[0] != ZIP64_EOCD_SIGNATURE:
+            raise ValueError("'%s' has a corrupt zip64 record" % f.name)
+        cdSize, cdOffset = zip64[8], zip64[9]
+
+    f.seek(cdOffset)
+    directory = f.read(cdSize)
+    headerSize = struct.calcsize(CENTRAL_FORMAT)
+    pos = 0
+    while pos + headerSize <= len(directory):
+        header = struct.unpack(CENTRAL_FORMAT, directory[pos:pos + headerSize])
+        if header[0] != CENTRAL_SIGNATURE:
+            raise ValueError("'%s' has a corrupt central directory" % f.name)
+        (_, _, _, flags, method, mtime, _, crc, csize, usize,
+         nameLength, extraLength, commentLength, _, _, _, localOffset) = header
+        extraStart = pos + headerSize + nameLength
+        extra = parseExtraField(directory[extraStart:extraStart + extraLength])
+
+        # replace the sizes and offset that overflowed with their zip64 values
+        if EXTRA_ZIP64 in extra:
+            zip64 = extra[EXTRA_ZIP64]
+            values = list(struct.unpack_from('<%iQ' % (len(zip64) // 8), zip64))
+            if usize == 0xFFFFFFFF and values:
+                usize = values.pop(0)
+            if csize == 0xFFFFFFFF and values:
+                csize = values.pop(0)
+            if localOffset == 0xFFFFFFFF and values:
+                localOffset = values.pop(0)
+
+        yield flags, method, mtime, crc, csize, localOffset, extra
+        pos = extraStart + extraLength + commentLength
+
+
+def parseExtraField(data):
+    """Return a dict of extra field id to data"""
+    fields = {}
+    pos = 0
+    while pos + 4 <= len(data):
+        fieldId, fieldSize = struct.unpack('<2H', data[pos:pos + 4])
+        fields[fieldId] = data[pos + 4:pos + 4 + fieldSize]
+        pos += 4 + fieldSize
+    return fields
+
+
+def zipCryptoDecrypt(password, data):
+    """Decrypt ZipCrypto (traditional PKWARE) encrypted bytes"""
+    key0, key1, key2 = 0x12345678, 0x23456789, 0x34567890
+
+    def updateKeys(c):
+        nonlocal key0, key1, key2
+        key0 = (key0 >> 8) ^ CRC_TABLE[(key0 ^ c) & 0xFF]
+        key1 = (key1 + (key0 & 0xFF)) & 0xFFFFFFFF
+        key1 = (key1 * 134775813 + 1) & 0xFFFFFFFF
+        key2 = (key2 >> 8) ^ CRC_TABLE[(key2 ^ (key1 >> 24)) & 0xFF]
+
+    for c in password:
+        updateKeys(c)
+
+    result = bytearray()
+    for c in data:
+        temp = (key2 | 2) & 0xFFFF
+        c ^= ((temp * (temp ^ 1)) >> 8) & 0xFF
+        updateKeys(c)
+        result.append(c)
+    return bytes(result)
+
+
+def verifyZipPassword(archive, zipPassword):
+    """Check a password against the smallest encrypted entry of an archive,
+       returns True or False or raises ValueError if nothing is encrypted"""
+    password = zipPassword.encode('utf-8')
+    with open(archive, 'rb') as f:
+        entries = [entry for entry in readCentralDirectory(f)
+                   if entry[0] & FLAG_ENCRYPTED]
+        if not entries:
+            raise ValueError("'%s' has no encrypted entries" % archive)
+        flags, method, mtime, crc, csize, localOffset, extra = \
+            min(entries, key=lambda entry: entry[4])
+
+        # skip over the local file header to the entry data
+        localSize = struct.calcsize(LOCAL_FORMAT)
+        f.seek(localOffset)
+        local = struct.unpack(LOCAL_FORMAT, f.read(localSize))
+        if local[0] != LOCAL_SIGNATURE:
+            raise ValueError("'%s' has a corrupt local file header" % archive)
+        f.seek(localOffset + localSize + local[9] + local[10])
+
+        # WinZip AES, the salt is followed by a 2 byte password verifier
+        if method == METHOD_AES:
+            aes = extra.get(EXTRA_AES, b'')
+            if len(aes) < 7 or aes[4] not in AES_SALT_LENGTHS:
+                raise ValueError("'%s' has an unknown AES strength" % archive)
+            saltLength = AES_SALT_LENGTHS[aes[4]]
+            keyLength = AES_KEY_LENGTHS[aes[4]]
+            header = f.read(saltLength + 2)
+            key = hashlib.pbkdf2_hmac('sha1', password, header[:saltLength],
+                                      AES_ITERATIONS, 2 * keyLength + 2)
+            return key[-2:] == header[saltLength:]
+
+        # ZipCrypto, the last byte of the 12 byte header is a check byte
+        if csize <= ZIPCRYPTO_CRC_CHECK_SIZE:
+            data = zipCryptoDecrypt(password, f.read(csize))
+        else:
+            data = zipCryptoDecrypt(password, f.read(ZIPCRYPTO_HEADER_SIZE))
+        if flags & FLAG_DATA_DESCRIPTOR:
+            check = (mtime >> 8) & 0xFF
+        else:
+            check = crc >> 24
+        if data[ZIPCRYPTO_HEADER_SIZE - 1] != check:
+            return False
+        if csize > ZIPCRYPTO_CRC_CHECK_SIZE or \
+                method not in (METHOD_STORED, METHOD_DEFLATED):
+            return True
+
+        data = data[ZIPCRYPTO_HEADER_SIZE:]
+        try:
+            if method == METHOD_DEFLATED:
+                data = zlib.decompress(data, -15)
+        except zlib.error:
+            return False
+        return zlib.crc32(data) == crc
+
+
+def passwordFromComment(comment):
+    """Return the zip password derived from the archive comment or None"""
+    comment = comment.decode(errors='replace')
+    for pattern in RID_PATTERN, IMEI_PATTERN:
+        match = pattern.search(comment)
+        if match:
+            passwordHash = match.group(1)
+            m = hashlib.sha1()
+            m.update(passwordHash.encode('utf-8'))
+            return(m.hexdigest().upper())
+    return None
+
 
 def extractFuriousGoldZipPassword(archive):
-    zf = zipfile.ZipFile(archive)
+    try:
+        zipPassword = passwordFromComment(readZipComment(archive))
+    except (OSError, ValueError):
+        zipPassword = None
+    if zipPassword is None:
+        sys.exit("Failed to find 'Rid' or 'IMEI' hash in '%s'" % archive)
+    return zipPassword
+
 
-    # look for Rid (from Android dumps)
+def extractArchivePassword(archive, verify=False):
+    """Return (archive, password, verified, error) for batch mode"""
     try:
-        pattern = re.compile('Rid: (\w+)')
-        match = pattern.search(zf.comment.decode())
-        passwordHash = match.group(1)
-        m = hashlib.sha1()
-        m.update(passwordHash.encode('utf-8'))
-        return(m.hexdigest().upper())
-    except:
-        pass
-
-    # look for IMEI (from MTK devices)
+        zipPassword = passwordFromComment(readZipComment(archive))
+    except (OSError, ValueError) as e:
+        return archive, '', '', str(e)
+    if zipPassword is None:
+        return archive, '', '', "Failed to find 'Rid' or 'IMEI' hash"
+    if not verify:
+        return archive, zipPassword, '', ''
     try:
-        pattern = re.compile('IMEI1 [OTP]: (\w+)')
-        match = pattern.search(zf.comment.decode())
-        passwordHash = match.group(1)
-        m = hashlib.sha1()
-        m.update(passwordHash.encode('utf-8'))
-        return(m.hexdigest().upper())
-    except:
-        sys.exit("Failed to find 'Rid' or 'IMEI' hash in '%s'" % archive)
+        return archive, zipPassword, verifyZipPassword(archive, zipPassword), ''
+    except (OSError, ValueError, struct.error) as e:
+        return archive, zipPassword, '', str(e)
+
+
+def findArchives(directory):
+    """Locate all files in and below a directory"""
+    for path, dirs, files in os.walk(directory):
+        for filename in sorted(files):
+            yield os.path.join(path, filename)
 
 
 def main():
@@ -44,9 +301,18 @@ def main():
         prog='furious-gold-extract-zip-password.py',
         description = '''Extract the Furious Gold zip password from physical or partition dumps.''')
 
-    parser.add_argument('-i', metavar='input_file', action='store',
-                        dest='inputfile', required=True,
-                        help='Furious Gold zip archive (ie. MEMORY_DUMP.osp)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', metavar='input_file', action='store',
+                       dest='inputfile',
+                       help='Furious Gold zip archive (ie. MEMORY_DUMP.osp)')
+    group.add_argument('-d', metavar='input_directory', action='store',
+                       dest='inputdir',
+                       help='Extract passwords for all archives in a directory (CSV output)')
+    parser.add_argument('-v', action='store_true', dest='verify',
+                        help='Verify the password against the archive')
+    parser.add_argument('-j', metavar='jobs', action='store', type=int,
+                        dest='jobs', default=8,
+                        help='Number of archives read concurrently (default: %(default)s)')
     args = parser.parse_args()
 
     # output help and exit when no arguments are given
@@ -54,10 +320,30 @@ def main():
         parser.print_help()
         return
 
+    # read all the archives in a directory and spit out a CSV of passwords
+    if args.inputdir:
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(('archive', 'password', 'verified', 'error'))
+        with ThreadPoolExecutor(args.jobs) as executor:
+            for row in executor.map(extractArchivePassword, findArchives(args.inputdir),
+                                    itertools.repeat(args.verify)):
+                writer.writerow(row)
+        return
+
     # open up the zip file and spit out the password
     zipPassword = extractFuriousGoldZipPassword(args.inputfile)
     print("The zip archive password is:", zipPassword)
 
+    # check the password against the archive
+    if args.verify:
+        try:
+            if verifyZipPassword(args.inputfile, zipPassword):
+                print("The zip archive password was verified.")
+            else:
+                sys.exit("The zip archive password is wrong.")
+        except (OSError, ValueError, struct.error) as e:
+            sys.exit("Failed to verify the password: %s" % e)
+
 
 if __name__ == '__main__':
     main()
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 #
 # Attempt to geographically locate an IPv4 address.
 #
@@ -10,22 +10,92 @@
 # Author: Derrick Karpo
 # Date:   January 23, 2008
 #
+# Notes:
+# o IPv4 and IPv6 addresses can also be located from a local GeoLite2 style
+#   CSV of network ranges without the GeoIP module ('-c').  The networks
+#   are loaded into sorted NumPy arrays and looked up in batches.  ie.
+#   -c GeoLite2-City-Blocks-IPv4.csv -c GeoLite2-City-Blocks-IPv6.csv
+#   -L GeoLite2-City-Locations-en.csv
+# o A blocks CSV needs a 'network' (CIDR) column or 'network_start_ip' and
+#   'network_last_ip' columns.  Locations come from 'city_name',
+#   'subdivision_1_name' and 'country_name' columns in the blocks CSV or
+#   in a locations CSV joined on 'geoname_id'.
+# o '-i' streams one IP per line from a file or stdin ('-') and prints a
+#   CSV row for each as it goes.  Repeated IPs are served from an LRU cache.
+# o The CSVs can be compiled once ('-C') to a compact binary database that
+#   is memory-mapped for near-instant startup ('-d').  ie.
+#   -c GeoLite2-City-Blocks-IPv4.csv -L GeoLite2-City-Locations-en.csv -C geo.db
+#   -d geo.db -i firewall-ips.txt
+# o '-a' extracts every IPv4/IPv6 address from log files across all cores,
+#   geolocates each unique address once and outputs the counts per
+#   country, city and IP (ie. -d geo.db -a proxy.log firewall.log).
+#
 
 import os
+import re
+import csv
 import sys
+import mmap
+import socket
+import struct
+import itertools
+import collections
+import multiprocessing
+from optparse import OptionParser
 
 try:
     import GeoIP
-    from optparse import OptionParser
 except ImportError:
-    raise ImportError, 'Missing GeoIP and OptionParser modules for python.'
+    GeoIP = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# location columns of a GeoLite2 style CSV, in output order
+LOCATION_COLUMNS = ('city_name', 'subdivision_1_name', 'country_name')
+
+# IPv4 addresses mapped into IPv6 (::ffff:0:0/96)
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+# compiled database layout: a header of magic, version and section counts
+# followed by 8 byte aligned little-endian arrays of IPv4 starts, ends and
+# location indices, IPv6 starts, ends and location indices, three string
+# ids (city, region, country) per location, string offsets and the UTF-8
+# string blob.  A string id of 0xFFFFFFFF is None.
+DATABASE_MAGIC = b'GEOIPRNG'
+DATABASE_VERSION = 1
+DATABASE_HEADER = '<8s6Q'
+NO_STRING = 0xFFFFFFFF
+
+# IPv4 and IPv6 addresses (including IPv4 suffixed IPv6) in arbitrary logs,
+# IPv6 candidates are validated with inet_pton().  IPv4 addresses may touch
+# a ':' as in 'ip:port' or 'src:ip'.  IPv6 candidates must contain a digit
+# and not touch a word character so 'std::vector' or 'Foo::bar' don't match.
+IPV4 = rb'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}' \
+       rb'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+IP_PATTERN = re.compile(rb'(?<![0-9A-Za-z_:.])(?=[0-9A-Fa-f:]*[0-9])(?:'
+                        rb'(?:[0-9A-Fa-f]{0,4}:){2,6}' + IPV4 +
+                        rb'|(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{0,4}'
+                        rb')(?![0-9A-Za-z_:]|\.[0-9])'
+                        rb'|(?<![0-9.])' + IPV4 + rb'(?![0-9]|\.[0-9])')
+
+# log bytes scanned per chunk when aggregating
+LOG_CHUNK_SIZE = 64 * 1024 * 1024
+
+# IPs looked up per batch and results kept in the LRU cache when streaming
+BATCH_SIZE = 1000
+CACHE_SIZE = 100000
 
 
 def parseOptions():
     if len(sys.argv) == 1:
         sys.argv.append('-h')
 
-    usage = "usage: %prog [-l|-w] ip"
+    usage = "usage: %prog [-l|-w|-c FILE|-d FILE] ip\n" \
+            "       %prog [-c FILE|-d FILE] -a logfile ..."
     description = "Attempt to geographically locate an IP address"
 
     parser = OptionParser(usage=usage, description=description)
@@ -33,12 +103,409 @@ def parseOptions():
                       help="Use local database (recommended).")
     parser.add_option("-w", action="store_true", dest="doweb",
                       help="Use Internet for lookup.")
+    parser.add_option("-c", action="append", dest="csvfiles", metavar="FILE",
+                      help="Use a GeoLite2 style network blocks CSV (repeat for IPv6).")
+    parser.add_option("-L", action="store", dest="locationsfile", metavar="FILE",
+                      help="GeoLite2 style locations CSV for the blocks CSV.")
+    parser.add_option("-d", action="store", dest="database", metavar="FILE",
+                      help="Use a geolocation database compiled with '-C'.")
+    parser.add_option("-C", action="store", dest="compile", metavar="FILE",
+                      help="Compile the '-c' and '-L' CSVs to a database FILE and exit.")
+    parser.add_option("-a", action="store_true", dest="aggregate",
+                      help="Treat the arguments as log files, extract their IPs "
+                           "and count them per country, city and IP.")
+    parser.add_option("-j", action="store", type="int", dest="jobs",
+                      metavar="JOBS",
+                      help="Number of processes scanning logs with '-a' (default: all cores).")
     parser.add_option("-i", action="store", type="string", dest="infile",
-                      help="Read input from FILE", metavar="FILE")
+                      help="Read input from FILE ('-' for stdin), one IP per line "
+                           "with CSV output", metavar="FILE")
+    parser.add_option("-b", action="store", type="int", dest="batchsize",
+                      default=BATCH_SIZE, metavar="LINES",
+                      help="IPs looked up per batch with '-i' (default: %default).")
+    parser.add_option("-s", action="store", type="int", dest="cachesize",
+                      default=CACHE_SIZE, metavar="IPS",
+                      help="Lookup results cached with '-i' (default: %default).")
     (opts, args) = parser.parse_args()
     return (opts, args)
 
 
+def packAddress(ip):
+    """Pack an IP address string to 4 (IPv4) or 16 (IPv6) bytes, IPv4 mapped
+       IPv6 addresses are packed as IPv4, returns None if invalid"""
+    try:
+        return socket.inet_pton(socket.AF_INET, ip)
+    except (OSError, ValueError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except (OSError, ValueError):
+        return None
+    if packed.startswith(IPV4_MAPPED_PREFIX):
+        return packed[12:]
+    return packed
+
+
+def networkRange(network):
+    """Return the packed first and last address of a CIDR network"""
+    address, _, prefix = network.partition('/')
+    packed = packAddress(address.strip())
+    if packed is None:
+        raise ValueError("Invalid network '%s'" % network)
+    bits = len(packed) * 8
+    mapped = bits == 32 and ':' in address
+    prefix = int(prefix) if prefix else 128 if mapped else bits
+    # IPv4 mapped IPv6 networks are packed as IPv4, drop the mapped prefix
+    if mapped:
+        if prefix < 96:
+            raise ValueError("IPv4 mapped network '%s' needs a prefix of at "
+                             "least 96" % network)
+        prefix -= 96
+    if not 0 <= prefix <= bits:
+        raise ValueError("Invalid prefix in network '%s'" % network)
+    hostbits = bits - prefix
+    start = int.from_bytes(packed, 'big') >> hostbits << hostbits
+    end = start | ((1 << hostbits) - 1)
+    return start.to_bytes(len(packed), 'big'), end.to_bytes(len(packed), 'big')
+
+
+def readLocations(filename):
+    """Read a GeoLite2 style locations CSV to a dict of geoname_id to
+       location tuple"""
+    locations = {}
+    with open(filename, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            locations[row['geoname_id']] = tuple(row.get(column) or None
+                                                 for column in LOCATION_COLUMNS)
+    return locations
+
+
+class GeoIPRanges(object):
+    """Sorted IPv4 and IPv6 network ranges, each with an index into a list of
+       deduplicated location tuples (city, region, country).  IPv4 addresses
+       are uint32 keys and IPv6 addresses are 16 byte big-endian keys so both
+       sort and search numerically."""
+
+    def __init__(self, starts4, ends4, index4, starts6, ends6, index6, locations):
+        self.starts4, self.ends4, self.index4 = starts4, ends4, index4
+        self.starts6, self.ends6, self.index6 = starts6, ends6, index6
+        self.locations = locations
+
+    @classmethod
+    def fromCSV(cls, blocksfiles, locationsfile=None):
+        """Load GeoLite2 style blocks CSVs and an optional locations CSV"""
+        geonames = readLocations(locationsfile) if locationsfile else {}
+        locations = []
+        locationIndex = {}
+        ranges = {4: ([], [], []), 16: ([], [], [])}
+
+        for filename in blocksfiles:
+            with open(filename, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    if row.get('network'):
+                        start, end = networkRange(row['network'])
+                    else:
+                        start = packAddress(row['network_start_ip'])
+                        end = packAddress(row['network_last_ip'])
+                        if start is None or end is None or len(start) != len(end):
+                            raise ValueError("Invalid range '%s-%s'"
+                                             % (row['network_start_ip'],
+                                                row['network_last_ip']))
+
+                    if any(row.get(column) for column in LOCATION_COLUMNS):
+                        location = tuple(row.get(column) or None
+                                         for column in LOCATION_COLUMNS)
+                    else:
+                        location = geonames.get(row.get('geoname_id')) or \
+                            geonames.get(row.get('registered_country_geoname_id'))
+                        if location is None:
+                            continue
+
+                    if location not in locationIndex:
+                        locationIndex[location] = len(locations)
+                        locations.append(location)
+                    starts, ends, index = ranges[len(start)]
+                    starts.append(start)
+                    ends.append(end)
+                    index.append(locationIndex[location])
+
+        def toArrays(starts, ends, index, dtype):
+            starts = np.frombuffer(b''.join(starts), dtype=dtype)
+            ends = np.frombuffer(b''.join(ends), dtype=dtype)
+            index = np.array(index, dtype=np.uint32)
+            if dtype == '>u4':
+                starts, ends = starts.astype(np.uint32), ends.astype(np.uint32)
+            order = np.argsort(starts, kind='stable')
+            return starts[order], ends[order], index[order]
+
+        return cls(*toArrays(*ranges[4], '>u4'), *toArrays(*ranges[16], 'S16'),
+                   locations)
+
+    def save(self, filename):
+        """Compile the ranges and deduplicated location strings to a binary
+           database file for fromFile()"""
+        strings = []
+        stringIndex = {}
+        locationIds = []
+        for location in self.locations:
+            for string in location:
+                if string is None:
+                    locationIds.append(NO_STRING)
+                    continue
+                if string not in stringIndex:
+                    stringIndex[string] = len(strings)
+                    strings.append(string.encode('utf-8'))
+                locationIds.append(stringIndex[string])
+        offsets = np.cumsum([0] + [len(string) for string in strings], dtype=np.uint64)
+
+        sections = [self.starts4.astype('<u4'), self.ends4.astype('<u4'),
+                    self.index4.astype('<u4'), self.starts6, self.ends6,
+                    self.index6.astype('<u4'),
+                    np.array(locationIds, dtype='<u4'), offsets.astype('<u8'),
+                    np.frombuffer(b''.join(strings), dtype=np.uint8)]
+        with open(filename, 'wb') as f:
+            f.write(struct.pack(DATABASE_HEADER, DATABASE_MAGIC, DATABASE_VERSION,
+                                len(self.starts4), len(self.starts6),
+                                len(self.locations), len(strings), len(sections[-1])))
+            for section in sections:
+                f.write(section.tobytes())
+                f.write(b'\0' * (-f.tell() % 8))
+
+    @classmethod
+    def fromFile(cls, filename):
+        """Memory-map a database file written by save(), the arrays share
+           the page cache with every other process using the same file"""
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        headerSize = struct.calcsize(DATABASE_HEADER)
+        magic, version, count4, count6, countLocations, countStrings, blobSize = \
+            struct.unpack_from(DATABASE_HEADER, mm)
+        if magic != DATABASE_MAGIC or version != DATABASE_VERSION:
+            raise ValueError("'%s' is not a compiled geolocation database" % filename)
+
+        offset = headerSize + (-headerSize % 8)
+        sections = []
+        for dtype, count in (('<u4', count4), ('<u4', count4), ('<u4', count4),
+                             ('S16', count6), ('S16', count6), ('<u4', count6),
+                             ('<u4', countLocations * 3), ('<u8', countStrings + 1),
+                             (np.uint8, blobSize)):
+            section = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+            sections.append(section)
+            offset += section.nbytes + (-section.nbytes % 8)
+
+        locations = MappedLocations(sections[6], sections[7], sections[8])
+        return cls(*sections[:6], locations)
+
+    def lookupIndices(self, ips):
+        """Return an array of location indices for a sequence of IP address
+           strings, -1 for invalid or unknown addresses"""
+        result = np.full(len(ips), -1, dtype=np.int64)
+        packed4, positions4 = [], []
+        packed6, positions6 = [], []
+        for position, ip in enumerate(ips):
+            packed = packAddress(ip)
+            if packed is None:
+                continue
+            if len(packed) == 4:
+                packed4.append(packed)
+                positions4.append(position)
+            else:
+                packed6.append(packed)
+                positions6.append(position)
+
+        if packed4:
+            keys = np.frombuffer(b''.join(packed4), dtype='>u4').astype(np.uint32)
+            result[positions4] = self._search(keys, self.starts4, self.ends4, self.index4)
+        if packed6:
+            keys = np.frombuffer(b''.join(packed6), dtype='S16')
+            result[positions6] = self._search(keys, self.starts6, self.ends6, self.index6)
+        return result
+
+    @staticmethod
+    def _search(keys, starts, ends, index):
+        """Return the location index of the range holding each key or -1"""
+        if not len(starts):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.searchsorted(starts, keys, side='right') - 1
+        found = (positions >= 0) & (keys <= ends[np.maximum(positions, 0)])
+        return np.where(found, index[np.maximum(positions, 0)].astype(np.int64), -1)
+
+    def lookup(self, ips):
+        """Return a list of (city, region, country) tuples for a sequence of
+           IP address strings, None for invalid or unknown addresses"""
+        return [self.locations[i] if i >= 0 else None
+                for i in self.lookupIndices(ips).tolist()]
+
+
+class MappedLocations(object):
+    """A read-only sequence of (city, region, country) tuples decoded on
+       demand from the string ids and string blob of a database file"""
+
+    def __init__(self, locationIds, offsets, blob):
+        self.locationIds = locationIds
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.locationIds) // 3
+
+    def string(self, stringId):
+        if stringId == NO_STRING:
+            return None
+        start, end = self.offsets[stringId:stringId + 2].tolist()
+        return self.blob[start:end].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return tuple(self.string(stringId)
+                     for stringId in self.locationIds[index * 3:index * 3 + 3].tolist())
+
+
+class LRUCache(object):
+    """A least recently used cache of a fixed number of results"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+def localLookup(geoip):
+    """Return a batch lookup function for the legacy GeoIP city database"""
+    def lookup(ips):
+        results = []
+        for ip in ips:
+            try:
+                r = geoip.record_by_addr(ip)
+                results.append((r['city'], r['region'], r['country_name']))
+            except:
+                results.append(None)
+        return results
+    return lookup
+
+
+def webLookup(geoip):
+    """Return a batch lookup function for the legacy GeoIP country lookup"""
+    def lookup(ips):
+        return [geoip.country_code_by_addr(ip) for ip in ips]
+    return lookup
+
+
+def streamLookups(lines, lookups, batchsize=BATCH_SIZE, cachesize=CACHE_SIZE):
+    """Yield a list of (ip, result for each lookup function) for each batch
+       of IPs in an iterable of lines.  Only the IPs of a batch that aren't
+       in the LRU cache are looked up, once each."""
+    cache = LRUCache(cachesize)
+    ips = (line.strip() for line in lines)
+    ips = (ip for ip in ips if ip)
+    while True:
+        batch = list(itertools.islice(ips, batchsize))
+        if not batch:
+            return
+
+        results = {}
+        misses = []
+        for ip in batch:
+            if ip in results:
+                continue
+            if ip in cache:
+                results[ip] = cache.get(ip)
+            else:
+                results[ip] = None
+                misses.append(ip)
+        if misses:
+            for ip, result in zip(misses, zip(*(lookup(misses) for lookup in lookups))):
+                results[ip] = result
+                cache.put(ip, result)
+        yield [(ip,) + results[ip] for ip in batch]
+
+
+def logChunks(filenames, chunksize=LOG_CHUNK_SIZE):
+    """Yield (filename, start, end) chunks of log files that end on a line
+       boundary so no address is split between chunks"""
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = 0
+                while start < size:
+                    end = mm.find(b'\n', min(start + chunksize, size) - 1)
+                    end = size if end < 0 else end + 1
+                    yield filename, start, end
+                    start = end
+
+
+def countChunkAddresses(chunk):
+    """Return a Counter of the canonical IP addresses in a chunk of a log"""
+    filename, start, end = chunk
+    with open(filename, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        matches = collections.Counter(IP_PATTERN.findall(mm, start, end))
+
+    counts = collections.Counter()
+    for match, count in matches.items():
+        packed = packAddress(match.decode('ascii'))
+        if packed is not None:
+            family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+            counts[socket.inet_ntop(family, packed)] += count
+    return counts
+
+
+def countLogAddresses(filenames, jobs=None, chunksize=LOG_CHUNK_SIZE):
+    """Count the IP addresses in log files, scanning chunks across a process
+       pool.  Memory is bounded by the number of unique addresses."""
+    counts = collections.Counter()
+    with multiprocessing.Pool(jobs) as pool:
+        for chunkCounts in pool.imap_unordered(countChunkAddresses,
+                                               logChunks(filenames, chunksize)):
+            counts.update(chunkCounts)
+    return counts
+
+
+def aggregateLogs(filenames, lookup, jobs=None):
+    """Print the per-country, per-city and per-IP counts of the addresses
+       in log files, each unique address is looked up once"""
+    counts = countLogAddresses(filenames, jobs)
+    ips = sorted(counts, key=lambda ip: (-counts[ip], ip))
+    locations = lookup(ips) if ips else []
+
+    countries = collections.Counter()
+    cities = collections.Counter()
+    for ip, location in zip(ips, locations):
+        city, region, country = location or (None, None, None)
+        countries[country or ''] += counts[ip]
+        cities[(country or '', region or '', city or '')] += counts[ip]
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    print("*** countries ***")
+    writer.writerow(('count', 'country'))
+    for country, count in countries.most_common():
+        writer.writerow((count, country))
+    print("\n*** cities ***")
+    writer.writerow(('count', 'country', 'region', 'city'))
+    for location, count in cities.most_common():
+        writer.writerow((count,) + location)
+    print("\n*** ips ***")
+    writer.writerow(('count', 'ip', 'city', 'region', 'country'))
+    for ip, location in zip(ips, locations):
+        writer.writerow((counts[ip], ip) + tuple(location or ('', '', '')))
+
+
 def main():
     # local and web lookup results
     results_local_lookup = {}
@@ -47,51 +514,117 @@ def main():
     # read command line options
     (opts, args) = parseOptions()
 
-    # parse file
-    if opts.infile:
+    if (opts.dolocal or opts.doweb) and GeoIP is None:
+        sys.exit("Missing GeoIP module for python.")
+
+    if opts.compile and not opts.csvfiles:
+        sys.exit("Compiling a database requires the CSVs ('-c').")
+
+    # batch lookup functions returning (city, region, country) or a country code
+    local = None
+    web = None
+
+    # search a GeoLite2 style CSV
+    if opts.csvfiles:
+        if np is None:
+            sys.exit("CSV lookups require NumPy.")
         try:
-            f = open(opts.infile, 'r')
-        except:
-            print "Unable to open input file '%s'" % opts.infile
+            ranges = GeoIPRanges.fromCSV(opts.csvfiles, opts.locationsfile)
+        except (IOError, KeyError, ValueError) as e:
+            sys.exit("Unable to load '%s': %s" % (', '.join(opts.csvfiles), e))
+        local = ranges.lookup
+
+        # compile the CSVs to a database and stop
+        if opts.compile:
+            try:
+                ranges.save(opts.compile)
+            except IOError as e:
+                sys.exit("Unable to write '%s': %s" % (opts.compile, e))
+            return
+
+    # search a compiled database
+    elif opts.database:
+        if np is None:
+            sys.exit("Compiled database lookups require NumPy.")
+        try:
+            local = GeoIPRanges.fromFile(opts.database).lookup
+        except (IOError, ValueError, struct.error) as e:
+            sys.exit("Unable to load '%s': %s" % (opts.database, e))
 
     # search local database
-    if opts.dolocal:
+    elif opts.dolocal:
         __dir__ = os.path.dirname(os.path.abspath(__file__))
         geoip_lib = os.path.join(__dir__, 'GeoLiteCity.dat')
-        geoip = GeoIP.open(geoip_lib, GeoIP.GEOIP_MEMORY_CACHE)
-
-        # parse command line ip's
-        for ip in args:
-            try:
-                r = geoip.record_by_addr(ip)
-                results_local_lookup[ip] = (r['city'],
-                          r['region'],
-                          r['country_name'])
-            except:
-                results_local_lookup[ip] = None
+        local = localLookup(GeoIP.open(geoip_lib, GeoIP.GEOIP_MEMORY_CACHE))
 
     # search web
     if opts.doweb:
-        geoip = GeoIP.new(GeoIP.GEOIP_MEMORY_CACHE)
+        web = webLookup(GeoIP.new(GeoIP.GEOIP_MEMORY_CACHE))
+
+    # count the IPs in log files by location
+    if opts.aggregate:
+        if not local:
+            sys.exit("Aggregating logs requires a lookup with '-c', '-d' or '-l'.")
+        try:
+            aggregateLogs(args, local, opts.jobs)
+        except (IOError, OSError) as e:
+            sys.exit("({})".format(e))
+        return
 
-        for ip in args:
-            results_web_lookup[ip] = geoip.country_code_by_addr(ip)
+    # stream the IPs from a file or stdin and print CSV as we go
+    if opts.infile:
+        lookups = [lookup for lookup in (local, web) if lookup]
+        if not lookups:
+            sys.exit("Specify a lookup with '-c', '-d', '-l' or '-w'.")
+        try:
+            f = sys.stdin if opts.infile == '-' else open(opts.infile, 'r')
+        except IOError:
+            sys.exit("Unable to open input file '%s'" % opts.infile)
+
+        header = ['ip']
+        if local:
+            header.extend(('city', 'region', 'country'))
+        if web:
+            header.append('country_code')
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(header)
+        for results in streamLookups(itertools.chain(args, f), lookups,
+                                     opts.batchsize, opts.cachesize):
+            rows = []
+            for result in results:
+                row = [result[0]]
+                if local:
+                    row.extend(result[1] or ('', '', ''))
+                if web:
+                    row.append(result[-1] or '')
+                rows.append(row)
+            writer.writerows(rows)
+            # flush each batch so results show up while reading stdin
+            if opts.infile == '-':
+                sys.stdout.flush()
+        return
+
+    if local:
+        for ip, location in zip(args, local(args)):
+            results_local_lookup[ip] = location
+    if web:
+        for ip, country in zip(args, web(args)):
+            results_web_lookup[ip] = country
 
     # print the local results
     if results_local_lookup:
-        results_local_lookups = sorted(results_local_lookup.iteritems(), key=lambda(k,v): k)
-        print "*** local results ***"
+        results_local_lookups = sorted(results_local_lookup.items(), key=lambda kv: kv[0])
+        print("*** local results ***")
         for result in results_local_lookups:
-            print result
+            print(result)
 
     # print the web results
     if results_web_lookup:
         # note: web lookup always returns "None" if not found
-        results_web_lookups = sorted(results_web_lookup.iteritems(), key=lambda(k,v): k)
-        print "*** web results ***"
+        results_web_lookups = sorted(results_web_lookup.items(), key=lambda kv: kv[0])
+        print("*** web results ***")
         for result in results_web_lookups:
-            print result
-
+            print(result)
 
 if __name__ == "__main__":
     main()
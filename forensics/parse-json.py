@@ -5,26 +5,453 @@
 # Author: Derrick Karpo
 # Date: April 4, 2013
 #
+# Notes:
+# o Records are read, parsed and written one line at a time so memory use
+#   stays flat and output starts straight away on huge NDJSON exports.
+# o Parallel mode ('-j') splits a file into newline aligned byte ranges that
+#   are parsed by a pool of worker processes.  Output is in file order
+#   unless '-u' is given, and each worker's record and error counts are
+#   reported when done.  Malformed lines are counted and skipped.
+# o Recovery mode ('-r') decodes objects one after another instead of by
+#   line, so concatenated and pretty printed multi-line objects are read.
+#   After an error it resyncs at the next '{' or '[' and reports the byte
+#   offset, length and reason of each skipped region, so carved or
+#   truncated JSON gives up everything recoverable in one pass.
+# o Projection mode ('-f') outputs only the given fields of each record as
+#   CSV, or TSV with '-t'.  Fields are comma separated dotted paths with
+#   optional list indexes and quoted keys, ie.
+#     -f 'id,user.name,messages[0].text,attachments[-1],meta["file.name"]'
+#   Missing fields are empty and objects or lists are output as JSON.
+# o An index ('-I') stores the start offset of each NDJSON record in
+#   FILE.idx, and with '-k FIELD' a map of the field's values to records
+#   in the SQLite database FILE.idx.db.  Records can then be read straight
+#   from the index by number or slice, numbered from 0 (ie. -n 1000 or
+#   -n 1000:2000), or by key (ie. -k user.id -K 1234).  Parallel mode
+#   splits an indexed file by record count instead of bytes.
+#
 
+import io
+import os
+import re
+import csv
 import sys
 import json
-from pprint import pprint
+import mmap
+import array
+import codecs
+import struct
+import sqlite3
+import collections
+import multiprocessing
 from optparse import OptionParser
 
 
+# size of the output buffer
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# bytes of input parsed per task in parallel mode
+RANGE_SIZE = 16 * 1024 * 1024
+
+# bytes read at a time in recovery mode, an object that is still incomplete
+# after MAX_OBJECT_SIZE bytes is treated as broken
+READ_SIZE = 1024 * 1024
+MAX_OBJECT_SIZE = 64 * 1024 * 1024
+
+# characters from the buffer end an error may be from a truncated token
+INCOMPLETE_MARGIN = 16
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+OBJECT_START = re.compile(r'[{\[]')
+
+# index file header of magic, source file size and source file mtime,
+# followed by the little-endian 64-bit record offsets
+INDEX_HEADER = struct.Struct('<8sQQ')
+INDEX_MAGIC = b'PJSONIDX'
+INDEX_SUFFIX = '.idx'
+KEYS_SUFFIX = '.idx.db'
+
+# records per task in parallel mode with an index, and per write when
+# building one
+RANGE_RECORDS = 100000
+
+# a key, list index or quoted key of a field path
+PATH_TOKEN = re.compile(r'''\.?([^.\[\]'"]+)|\[(-?\d+)\]|\[(['"])(.*?)\3\]''')
+
+
 def parseOptions():
     if len(sys.argv) == 1:
         sys.argv.append('-h')
 
-    usage = "usage: %prog [options] filename"
+    usage = "usage: %prog [options] filename ('-' for stdin)"
     description = "Parse JSON data and output it in various formats"
 
     parser = OptionParser(usage=usage, description=description)
     parser.add_option("-p", action="store_true", dest="pprint",
                       help="Pretty print the JSON output.")
+    parser.add_option("-f", action="store", dest="fields", metavar="FIELDS",
+                      help="Output only these comma separated field paths as CSV.")
+    parser.add_option("-t", action="store_true", dest="tsv",
+                      help="Output the fields as TSV instead of CSV.")
+    parser.add_option("-I", action="store_true", dest="index",
+                      help="Build a record offset index of the file.")
+    parser.add_option("-k", action="store", dest="keyfield", metavar="FIELD",
+                      help="Index the values of this field path, or look it up with '-K'.")
+    parser.add_option("-K", action="store", dest="key", metavar="VALUE",
+                      help="Output the records whose '-k' field is VALUE.")
+    parser.add_option("-n", action="store", dest="records", metavar="N[:M]",
+                      help="Output record N or the records N to M from the index.")
+    parser.add_option("-r", action="store_true", dest="recover",
+                      help="Recover objects from malformed, concatenated or carved JSON.")
+    parser.add_option("-j", action="store", type="int", dest="jobs",
+                      metavar="JOBS",
+                      help="Parse the file with JOBS worker processes.")
+    parser.add_option("-u", action="store_true", dest="unordered",
+                      help="Output records as workers finish instead of in file order.")
     (opts, args) = parser.parse_args()
     return (opts, args)
 
+
+def readRecords(f):
+    """Yield each parsed JSON line of a binary file, skipping blank lines"""
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValueError("line {}: {}".format(number, e))
+
+
+def recoverRecords(f, skipped):
+    """Yield each JSON object or array decoded from a binary file in turn,
+       resyncing at the next '{' or '[' after an error.  Each skipped region
+       is appended to skipped as (byte offset, byte length, reason)."""
+    decoder = json.JSONDecoder()
+    # undecodable bytes become lone surrogates so byte offsets stay exact
+    decode = codecs.getincrementaldecoder('utf-8')('surrogateescape').decode
+    buf = ''
+    pos = 0
+    eof = False
+    # a character index into buf and its byte offset in the file, offsets
+    # are only asked for in increasing order so each step encodes only the
+    # text after the last one
+    mark = [0, 0]
+
+    def byteOffset(index):
+        if buf.isascii():
+            offset = mark[1] + index - mark[0]
+        else:
+            offset = mark[1] + len(buf[mark[0]:index].encode('utf-8', 'surrogateescape'))
+        mark[:] = index, offset
+        return offset
+
+    def skip(start, end, reason):
+        # trailing whitespace isn't part of the region
+        end = start + len(buf[start:end].rstrip(' \t\n\r'))
+        offset = byteOffset(start)
+        length = byteOffset(end) - offset
+        # join regions that run on, keeping the first reason
+        if skipped and skipped[-1][0] + skipped[-1][1] == offset:
+            offset, previous, reason = skipped.pop()
+            length += previous
+        skipped.append((offset, length, reason))
+
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                return
+        elif buf[pos] not in '{[':
+            # garbage between objects, skip to the next plausible start
+            match = OBJECT_START.search(buf, pos)
+            end = match.start() if match else len(buf)
+            skip(pos, end, "not an object")
+            pos = end
+            continue
+        else:
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                # an object ending at the buffer end may be cut short
+                if end < len(buf) or eof:
+                    yield record
+                    pos = end
+                    continue
+            except ValueError as e:
+                # an error near the buffer end may just need more data
+                incomplete = e.pos >= len(buf) - INCOMPLETE_MARGIN or \
+                    e.msg.startswith('Unterminated string')
+                if eof or not incomplete or len(buf) - pos > MAX_OBJECT_SIZE:
+                    match = OBJECT_START.search(buf, pos + 1)
+                    end = match.start() if match else len(buf)
+                    skip(pos, end, e.msg)
+                    pos = end
+                    continue
+
+        # drop what is consumed and read more, doubling the buffer for an
+        # object that is still incomplete so it isn't reparsed too often
+        data = f.read(max(READ_SIZE, len(buf) - pos))
+        eof = not data
+        mark[:] = 0, byteOffset(pos)
+        buf = buf[pos:] + decode(data, eof)
+        pos = 0
+
+
+def compilePath(path):
+    """Compile a field path like '$.user.name' or 'messages[0]["text"]' to a
+       tuple of dict keys and list indexes, an index of a string isn't
+       checked and gives a character"""
+    keys = []
+    pos = 1 if path.startswith('$') else 0
+    while pos < len(path):
+        match = PATH_TOKEN.match(path, pos)
+        if not match or (match.group(1) and pos and path[pos] != '.'):
+            raise ValueError("Invalid field path: {}".format(path))
+        name, index, _, quoted = match.groups()
+        keys.append(int(index) if index is not None else
+                    name if name is not None else quoted)
+        pos = match.end()
+    if not keys:
+        raise ValueError("Invalid field path: {}".format(path))
+    return tuple(keys)
+
+
+def extractField(record, keys):
+    """Return the value at a compiled field path of a record as a string,
+       empty if it is missing"""
+    try:
+        for key in keys:
+            record = record[key]
+    except (KeyError, IndexError, TypeError):
+        return ''
+    # cheap conversions first, json.dumps is slow for a single value
+    kind = type(record)
+    if kind is str:
+        return record
+    if kind is int or kind is float:
+        return repr(record)
+    if record is None:
+        return ''
+    if kind is bool:
+        return 'true' if record else 'false'
+    return json.dumps(record, ensure_ascii=False)
+
+
+def writeRecords(records, out, pretty=False, fields=None, delimiter=','):
+    """Write each record as it arrives, pretty printed or as one line, or
+       only the compiled field paths as a CSV row"""
+    if fields:
+        writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+        writer.writerows([extractField(record, keys) for keys in fields]
+                         for record in records)
+        return
+
+    indent = 4 if pretty else None
+    for record in records:
+        out.write(json.dumps(record, indent=indent, ensure_ascii=False))
+        out.write('\n')
+
+
+def statIndex(f):
+    """Return the size and mtime of an open file that an index is built from"""
+    stat = os.fstat(f.fileno())
+    return stat.st_size, stat.st_mtime_ns
+
+
+def buildIndex(filename, keyfield=None):
+    """Write the start offset of each record of an NDJSON file to FILE.idx,
+       and with a field path the values of that field to FILE.idx.db.
+       Returns the number of records."""
+    keys = compilePath(keyfield) if keyfield else None
+    db = None
+    if keys:
+        db = sqlite3.connect(filename + KEYS_SUFFIX)
+        db.execute('CREATE TABLE IF NOT EXISTS keys '
+                   '(field TEXT, key TEXT, record INTEGER)')
+        db.execute('CREATE INDEX IF NOT EXISTS keys_field_key ON keys (field, key)')
+        db.execute('DELETE FROM keys WHERE field = ?', (keyfield,))
+
+    count = 0
+    with open(filename, 'rb') as f, open(filename + INDEX_SUFFIX, 'wb') as index:
+        index.write(INDEX_HEADER.pack(INDEX_MAGIC, *statIndex(f)))
+        offsets = array.array('Q')
+        rows = []
+        offset = 0
+        for line in f:
+            if line.strip():
+                offsets.append(offset)
+                if keys:
+                    try:
+                        key = extractField(json.loads(line), keys)
+                    except ValueError:
+                        key = ''
+                    if key:
+                        rows.append((keyfield, key, count))
+                count += 1
+                if len(offsets) == RANGE_RECORDS:
+                    writeOffsets(index, offsets, db, rows)
+            offset += len(line)
+        writeOffsets(index, offsets, db, rows)
+
+    if db is not None:
+        db.commit()
+        db.close()
+    return count
+
+
+def writeOffsets(index, offsets, db, rows):
+    """Write and clear a batch of record offsets and key rows"""
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    offsets.tofile(index)
+    del offsets[:]
+    if db is not None:
+        db.executemany('INSERT INTO keys VALUES (?, ?, ?)', rows)
+    del rows[:]
+
+
+def loadIndex(filename):
+    """Return the record offsets from the index of a file as a sequence,
+       raising ValueError if there is no index or it is out of date"""
+    if not os.path.exists(filename + INDEX_SUFFIX):
+        raise ValueError("{} has no index, build it with '-I'".format(filename))
+    with open(filename, 'rb') as f, open(filename + INDEX_SUFFIX, 'rb') as index:
+        header = index.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size or \
+                INDEX_HEADER.unpack(header)[0] != INDEX_MAGIC:
+            raise ValueError("{} is not an index".format(index.name))
+        if INDEX_HEADER.unpack(header)[1:] != statIndex(f):
+            raise ValueError("{} is out of date, rebuild it with '-I'"
+                             .format(index.name))
+        if index.seek(0, os.SEEK_END) == INDEX_HEADER.size:
+            return []
+        mm = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if sys.byteorder == 'big':
+        offsets = array.array('Q')
+        offsets.frombytes(mm[INDEX_HEADER.size:])
+        offsets.byteswap()
+        return offsets
+    return memoryview(mm)[INDEX_HEADER.size:].cast('Q')
+
+
+def lookupKey(filename, keyfield, key):
+    """Return the numbers of the records whose field has a value"""
+    if not os.path.exists(filename + KEYS_SUFFIX):
+        raise ValueError("{} has no key index, build it with '-I -k'".format(filename))
+    db = sqlite3.connect('file:{}?mode=ro'.format(filename + KEYS_SUFFIX), uri=True)
+    try:
+        if db.execute('SELECT 1 FROM keys WHERE field = ? LIMIT 1',
+                      (keyfield,)).fetchone() is None:
+            raise ValueError("{} is not indexed, build it with '-I -k'".format(keyfield))
+        return [record for record, in db.execute(
+            'SELECT record FROM keys WHERE field = ? AND key = ? ORDER BY record',
+            (keyfield, key))]
+    finally:
+        db.close()
+
+
+def recordRange(records, count):
+    """Return the (start, stop) records of 'N' or a slice like 'N:M' of
+       count records, negative numbers count from the end"""
+    try:
+        bounds = [int(b) if b.strip() else None for b in records.split(':')]
+        if len(bounds) > 2 or (len(bounds) == 1 and bounds[0] is None):
+            raise ValueError
+    except ValueError:
+        raise ValueError("Invalid record range: {}".format(records))
+
+    if len(bounds) == 1:
+        if not -count <= bounds[0] < count:
+            raise ValueError("Record {} is out of range".format(bounds[0]))
+        start = bounds[0] % count
+        return start, start + 1
+    start, stop, _ = slice(*bounds).indices(count)
+    return start, max(start, stop)
+
+
+def readIndexedRecords(f, offsets, numbers):
+    """Yield the parsed records of a binary file with the given numbers"""
+    for number in numbers:
+        f.seek(offsets[number])
+        try:
+            yield json.loads(f.readline())
+        except ValueError as e:
+            raise ValueError("record {}: {}".format(number, e))
+
+
+def indexRanges(filename, offsets, rangerecords=RANGE_RECORDS):
+    """Yield (start, end) byte ranges of an indexed file that each hold
+       rangerecords records"""
+    size = os.path.getsize(filename)
+    for first in range(0, len(offsets), rangerecords):
+        last = first + rangerecords
+        yield offsets[first], offsets[last] if last < len(offsets) else size
+
+
+def byteRanges(filename, rangesize=RANGE_SIZE):
+    """Yield (start, end) byte ranges of a file that end on a newline"""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < size:
+            f.seek(min(start + rangesize, size) - 1)
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def parseRange(job):
+    """Parse a byte range of a file and return (output text, records, errors,
+       worker pid), malformed lines are counted and skipped"""
+    filename, start, end, pretty, fields, delimiter = job
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+
+    counts = [0, 0]
+
+    def parse():
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                counts[1] += 1
+                continue
+            counts[0] += 1
+            yield record
+
+    output = io.StringIO()
+    writeRecords(parse(), output, pretty, fields, delimiter)
+    return output.getvalue(), counts[0], counts[1], os.getpid()
+
+
+def parallelParse(filename, out, jobs, pretty=False, unordered=False,
+                  fields=None, delimiter=',', offsets=None):
+    """Parse a file across worker processes and write the records, then
+       report the records and errors of each worker.  With the offsets from
+       an index the file is split by record count."""
+    workers = collections.OrderedDict()
+    ranges = indexRanges(filename, offsets) if offsets is not None else \
+        byteRanges(filename)
+    ranges = ((filename, start, end, pretty, fields, delimiter)
+              for start, end in ranges)
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.imap_unordered(parseRange, ranges) if unordered else \
+            pool.imap(parseRange, ranges)
+        for text, records, errors, pid in results:
+            out.write(text)
+            counts = workers.setdefault(pid, [0, 0])
+            counts[0] += records
+            counts[1] += errors
+
+    for number, (records, errors) in enumerate(workers.values(), 1):
+        sys.stderr.write("worker {}: {} records, {} errors\n"
+                         .format(number, records, errors))
+
+
 def main():
     # read command line options
     (opts, args) = parseOptions()
@@ -32,16 +459,73 @@ def main():
     # read the JSON file and parse it, this is read line-by-line
     # just in case malformed JSON is fed in as we may be able to
     # extract more data than reading in entire file in one read
+    out = io.TextIOWrapper(open(sys.stdout.fileno(), 'wb', OUTPUT_BUFFER_SIZE,
+                                closefd=False), encoding='utf-8',
+                           errors='surrogateescape')
     try:
-        data = []
-        with open(args[0]) as f:
-            for line in f:
-                data.append(json.loads(line))
-
-        if opts.pprint:
-            print(data.decode("unicode_escape").encode("utf8","replace"))
-    except IOError as e:
+        # compile the field paths and write the header row
+        fields = None
+        delimiter = '\t' if opts.tsv else ','
+        if opts.fields:
+            paths = opts.fields.split(',')
+            fields = [compilePath(path.strip()) for path in paths]
+            csv.writer(out, delimiter=delimiter, lineterminator='\n').writerow(
+                path.strip() for path in paths)
+
+        indexed = opts.index or opts.key is not None or opts.records
+        if (opts.jobs or indexed) and args[0] == '-':
+            sys.exit("Parallel and index modes can't read from stdin.")
+        if (opts.jobs or indexed) and opts.recover:
+            sys.exit("Parallel and index modes can't be used with recovery mode.")
+
+        # build the index
+        if opts.index:
+            count = buildIndex(args[0], opts.keyfield)
+            sys.stderr.write("indexed {} records\n".format(count))
+            return
+
+        # read records straight from the index
+        if indexed:
+            offsets = loadIndex(args[0])
+            if opts.key is not None:
+                if not opts.keyfield:
+                    sys.exit("A key lookup requires a field ('-k').")
+                numbers = lookupKey(args[0], opts.keyfield, opts.key)
+            else:
+                numbers = range(*recordRange(opts.records, len(offsets)))
+            with open(args[0], 'rb') as f:
+                writeRecords(readIndexedRecords(f, offsets, numbers), out,
+                             opts.pprint, fields, delimiter)
+            return
+
+        if opts.jobs:
+            # split by record count if there is an up to date index
+            try:
+                offsets = loadIndex(args[0])
+            except ValueError:
+                offsets = None
+            parallelParse(args[0], out, opts.jobs, opts.pprint, opts.unordered,
+                          fields, delimiter, offsets)
+            return
+        f = sys.stdin.buffer if args[0] == '-' else open(args[0], 'rb')
+        with f:
+            if opts.recover:
+                skipped = []
+                writeRecords(recoverRecords(f, skipped), out, opts.pprint,
+                             fields, delimiter)
+                for offset, length, reason in skipped:
+                    sys.stderr.write("skipped {} bytes at offset {}: {}\n"
+                                     .format(length, offset, reason))
+            else:
+                writeRecords(readRecords(f), out, opts.pprint, fields,
+                             delimiter)
+    except (IOError, ValueError, sqlite3.Error) as e:
         sys.exit("({})".format(e))
+    finally:
+        try:
+            out.flush()
+        except BrokenPipeError:
+            pass
 
 
 if __name__ == "__main__":
@@ -5,12 +5,349 @@
 # Author: Derrick Karpo
 # Date: September 20, 2019
 #
+# Notes:
+# o Days are downloaded concurrently ('-j') over a shared pooled session,
+#   with at most '-c' connections to any one host.  A day that fails or has
+#   no CSV is reported and the rest of the range carries on.
+# o The base URL ('-b') can point at a local stand-in server for testing.
+# o CSVs are streamed to a temporary file that is renamed into place once
+#   complete.  Completed days of each user are recorded in a state file
+#   ('-S') and skipped on the next run, so an interrupted range can simply
+#   be rerun.
+#   '-r' rechecks completed days with conditional requests and only
+#   downloads the CSVs that changed.
+# o Merge mode ('-m') streams the downloaded daily CSVs (or those given)
+#   into one chronologically sorted track with duplicate fixes removed.
+#   Timestamps are normalized to 'YYYY-MM-DD HH:MM:SS' in a leading
+#   'timestamp' column, built from a timestamp column or separate date and
+#   time columns ('-t' to name them).  '-B' keeps only the first fix in
+#   each bucket of that many seconds, ie. -m track.csv -B 60
+#
 
 import requests
+import os
+import csv
 import sys
+import glob
+import json
+import heapq
 import argparse
+import calendar
+import tempfile
+import threading
+import urllib.parse
 from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+
+# default base URL, number of concurrent days and connections per host
+URL_BASE = 'http://map.trackingtheworld.com'
+JOBS = 8
+HOST_CONNECTIONS = 4
+
+# seconds to wait for a connection or a read
+TIMEOUT = 60
+
+# default state file of completed days and bytes written at a time
+STATE_FILE = 'tracking-the-world-state.json'
+CHUNK_SIZE = 64 * 1024
+
+# downloaded daily CSVs merged by default
+DAILY_CSV_GLOB = '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]-*.csv'
+
+# timestamp formats tried in turn and the column names that are looked for
+# when none are given, a single timestamp column or a date and a time column
+TIMESTAMP_FORMATS = ['%m/%d/%Y %H:%M:%S', '%m/%d/%Y %I:%M:%S %p',
+                     '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                     '%m/%d/%Y %H:%M', '%m/%d/%Y %I:%M %p', '%Y-%m-%d %H:%M']
+TIMESTAMP_COLUMNS = ['timestamp', 'datetime', 'date time', 'date/time', 'time stamp']
+DATE_COLUMNS = ['date', 'gps date']
+TIME_COLUMNS = ['time', 'gps time']
+
+
+class HostLimiter:
+    """Limit the number of concurrent requests to each host"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[host]
+
+
+class DownloadState:
+    """The completed days of a user, saved to a JSON file as each day
+       completes.  Days are keyed by user so one file can serve many."""
+
+    def __init__(self, filename, username):
+        self.filename = filename
+        self.username = username
+        self.lock = threading.Lock()
+        try:
+            with open(filename) as f:
+                self.days = json.load(f)
+        except FileNotFoundError:
+            self.days = {}
+
+    def key(self, day):
+        return '{}:{}'.format(self.username, day.strftime('%m-%d-%Y'))
+
+    def get(self, day):
+        """Return the saved state of a day if its CSV still exists"""
+        with self.lock:
+            entry = self.days.get(self.key(day))
+        if entry and os.path.exists(entry['file']):
+            return entry
+        return None
+
+    def complete(self, day, entry):
+        with self.lock:
+            self.days[self.key(day)] = entry
+            saveAtomically(self.filename, json.dumps(self.days, indent=1,
+                                                     sort_keys=True).encode())
+
+
+def saveAtomically(fname, chunks):
+    """Write bytes or an iterable of byte chunks to a temporary file and
+       rename it to fname once complete"""
+    directory = os.path.dirname(os.path.abspath(fname))
+    fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(fname) + '.',
+                                   dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if isinstance(chunks, bytes):
+                chunks = (chunks,)
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmpname, fname)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def createSession(connections):
+    """Return a session that keeps up to connections connections alive"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=connections,
+                                            pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(session, limiter, url):
+    """GET a URL within the host limit and raise for an HTTP error"""
+    with limiter(url):
+        r = session.get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r
+
+
+def downloadCSV(session, limiter, url, fname, entry=None):
+    """Stream a CSV to fname and return its state entry, or None if it is
+       unchanged since a previous entry"""
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('modified'):
+        headers['If-Modified-Since'] = entry['modified']
+
+    with limiter(url), session.get(url, headers=headers, stream=True,
+                                   timeout=TIMEOUT) as r:
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        saveAtomically(fname, r.iter_content(CHUNK_SIZE))
+        return {'file': fname, 'url': url, 'etag': r.headers.get('ETag'),
+                'modified': r.headers.get('Last-Modified')}
+
+
+def downloadDay(session, limiter, state, urlBase, username, password, day,
+                recheck=False):
+    """Download the CSV of one day, returning a message for the day"""
+    # skip a completed day, or check that its CSV hasn't changed
+    entry = state.get(day)
+    if entry and not recheck:
+        return True, "Already downloaded {} as {}.".format(day, entry['file'])
+    if entry:
+        try:
+            result = downloadCSV(session, limiter, entry['url'], entry['file'], entry)
+        except requests.exceptions.RequestException as e:
+            return False, "Failed to recheck the CSV for {} ({})".format(day, e)
+        except OSError as e:
+            return False, "Failed to save the CSV for {} ({})".format(day, e)
+        if result is None:
+            return True, "Unchanged CSV for {} in {}.".format(day, entry['file'])
+        state.complete(day, result)
+        return True, "Updated CSV for {} in {}.".format(day, entry['file'])
+
+    # build our initial request URL
+    urlFirst = urlBase + '/gmap-bmap.aspx?name=' + username + '&calDate=' + day.strftime('%m/%d/%Y') + '%2012:00:00%20AM&gpasswd=' + password
+
+    # pull the initial HTML which contains the CSV link
+    try:
+        r = fetch(session, limiter, urlFirst)
+    except requests.exceptions.RequestException as e:
+        return False, "Failed to get the page for {} ({})".format(day, e)
+    soup = BeautifulSoup(r.content, features='lxml')
+    # grab the CSV link via the "id=HyperLink2" tag
+    a = soup.find(id='HyperLink2', href=True)
+
+    # if the link can't be found, move on to the next day
+    if a is None:
+        return True, "No link found for {}. Continuing...".format(day)
+
+    # connect to the CSV link and download it
+    try:
+        fname = a['href'].rsplit('/')[1]
+    except (IndexError, KeyError, ValueError) as e:
+        return False, "Unexpected CSV link for {} ({})".format(day, e)
+    csvurl = urlBase + '/archives/' + fname
+    fname = day.strftime('%m-%d-%Y') + '-' + fname
+
+    # write out the CSV as 'date + original filename' to your currect directory
+    try:
+        state.complete(day, downloadCSV(session, limiter, csvurl, fname))
+    except requests.exceptions.RequestException as e:
+        return False, "Failed to download the CSV for {} ({})".format(day, e)
+    except OSError as e:
+        return False, "Failed to save the CSV for {} ({})".format(day, e)
+    return True, "Found CSV download link for {}. Saved as {}.".format(day, fname)
+
+
+def findTimestampColumns(header, names=None):
+    """Return the indexes of the timestamp columns of a CSV header, either
+       the named columns or a timestamp or date and time column"""
+    lower = [column.strip().lower() for column in header]
+    if names:
+        try:
+            return [lower.index(name.strip().lower()) for name in names]
+        except ValueError:
+            raise ValueError("Timestamp column(s) {} not in {}".format(
+                ', '.join(names), ', '.join(header)))
+    for candidates in [TIMESTAMP_COLUMNS], [DATE_COLUMNS, TIME_COLUMNS], [DATE_COLUMNS]:
+        found = [next((lower.index(c) for c in column if c in lower), None)
+                 for column in candidates]
+        if None not in found:
+            return found
+    raise ValueError("No timestamp column in {}, name it with '-t'".format(
+        ', '.join(header)))
+
+
+def parseTimestamp(value, formats=TIMESTAMP_FORMATS):
+    """Normalize a timestamp to 'YYYY-MM-DD HH:MM:SS' or return None, the
+       format that matches is moved to the front for the next call"""
+    for index, fmt in enumerate(formats):
+        try:
+            timestamp = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if index:
+            formats.insert(0, formats.pop(index))
+        return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    return None
+
+
+def readTrack(fname, columns, outheader, invalid):
+    """Yield [timestamp, values...] rows of a daily CSV with the values in
+       the order of outheader, counting rows with a bad timestamp in
+       invalid[0]"""
+    with open(fname, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        if not header:
+            return
+        tscolumns = findTimestampColumns(header, columns)
+        names = [column.strip() for column in header]
+        order = [names.index(name) if name in names else None
+                 for name in outheader]
+        for row in reader:
+            if not row:
+                continue
+            try:
+                timestamp = parseTimestamp(' '.join(row[c].strip() for c in tscolumns))
+            except IndexError:
+                timestamp = None
+            if timestamp is None:
+                invalid[0] += 1
+                continue
+            yield [timestamp] + [row[i] if i is not None and i < len(row) else ''
+                                 for i in order]
+
+
+def sortedTrack(fname, columns, outheader, invalid, tmpdir):
+    """Return a generator of the rows of a daily CSV in time order, a file
+       that isn't in order is sorted to a temporary run file first"""
+    rows = list(readTrack(fname, columns, outheader, invalid))
+    if all(a[0] <= b[0] for a, b in zip(rows, rows[1:])):
+        del rows
+        return readTrack(fname, columns, outheader, [0])
+
+    rows.sort(key=lambda row: row[0])
+    run = tempfile.NamedTemporaryFile('w', newline='', suffix='.csv',
+                                      dir=tmpdir, delete=False)
+    with run:
+        csv.writer(run).writerows(rows)
+    del rows
+
+    def readRun():
+        with open(run.name, newline='') as f:
+            yield from csv.reader(f)
+    return readRun()
+
+
+def trackHeader(fname, columns):
+    """Return the non-timestamp column names of a daily CSV"""
+    with open(fname, newline='') as f:
+        header = next(csv.reader(f), [])
+    tscolumns = findTimestampColumns(header, columns)
+    return [name.strip() for i, name in enumerate(header) if i not in tscolumns]
+
+
+def mergeTracks(files, output, columns=None, bucket=None):
+    """Merge daily CSVs into one time sorted track without duplicate rows,
+       keeping the first row of each bucket of seconds if given.  Returns
+       the number of rows written and rows with an invalid timestamp."""
+    outheader = trackHeader(files[0], columns)
+    invalid = [0]
+    written = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tracks = [sortedTrack(fname, columns, outheader, invalid, tmpdir)
+                  for fname in files]
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(['timestamp'] + outheader)
+
+        # rows with the same timestamp may come from any file, so the rows
+        # seen are kept until the timestamp changes
+        last = None
+        seen = set()
+        lastbucket = None
+        for row in heapq.merge(*tracks, key=lambda row: row[0]):
+            if row[0] != last:
+                last = row[0]
+                seen.clear()
+                if bucket:
+                    seconds = calendar.timegm(datetime.strptime(
+                        last, '%Y-%m-%d %H:%M:%S').timetuple())
+                    if seconds // bucket == lastbucket:
+                        continue
+                    lastbucket = seconds // bucket
+            elif bucket:
+                continue
+            key = tuple(row)
+            if key in seen:
+                continue
+            seen.add(key)
+            writer.writerow(row)
+            written += 1
+    return written, invalid[0]
 
 
 def main():
@@ -20,24 +357,65 @@ def main():
         description = "Download the raw .csv file from 'Tracking The World'.",
         formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    parser.add_argument('-u', action='store', dest='username', required=True,
+    parser.add_argument('-u', action='store', dest='username',
                         help='Username (required: ie. 12345)')
     parser.add_argument('-p', action='store', dest='password', default='0000',
                         help='Password (optional: default is 0000)')
-    parser.add_argument('-s', action='store', dest='startdate', required=True,
+    parser.add_argument('-s', action='store', dest='startdate',
                         help='ie. 01-15-2019')
-    parser.add_argument('-e', action='store', dest='enddate', required=True,
+    parser.add_argument('-e', action='store', dest='enddate',
                         help='ie. 02-15-2019')
-
-    args = parser.parse_args()
+    parser.add_argument('-b', action='store', dest='urlbase', default=URL_BASE,
+                        help='Base URL (optional: default is %(default)s)')
+    parser.add_argument('-j', action='store', dest='jobs', type=int,
+                        default=JOBS,
+                        help='Days downloaded at once (optional: default is %(default)s)')
+    parser.add_argument('-c', action='store', dest='connections', type=int,
+                        default=HOST_CONNECTIONS,
+                        help='Connections per host (optional: default is %(default)s)')
+    parser.add_argument('-S', action='store', dest='statefile', default=STATE_FILE,
+                        help='State file of completed days (optional: default is %(default)s)')
+    parser.add_argument('-r', action='store_true', dest='recheck',
+                        help='Recheck completed days for changed CSVs')
+    parser.add_argument('-m', action='store', dest='merge',
+                        help="Merge the daily CSVs into this track CSV ('-' for stdout)")
+    parser.add_argument('-t', action='append', dest='columns',
+                        help='Timestamp column, or date then time column (ie. -t Date -t Time)')
+    parser.add_argument('-B', action='store', dest='bucket', type=int,
+                        help='Keep the first fix of each bucket of seconds when merging')
+    parser.add_argument('files', nargs='*',
+                        help='Daily CSVs to merge (optional: default is the downloaded CSVs)')
 
     # output help and exit when no arguments are given
     if len(sys.argv) == 1:
         parser.print_help()
         return
 
+    args = parser.parse_args()
+
+    # merge the daily CSVs
+    if args.merge:
+        files = args.files or sorted(glob.glob(DAILY_CSV_GLOB))
+        if not files:
+            sys.exit("No daily CSVs to merge.")
+        try:
+            if args.merge == '-':
+                written, invalid = mergeTracks(files, sys.stdout, args.columns, args.bucket)
+            else:
+                with open(args.merge + '.tmp', 'w', newline='') as output:
+                    written, invalid = mergeTracks(files, output, args.columns, args.bucket)
+                os.replace(args.merge + '.tmp', args.merge)
+        except (OSError, ValueError) as e:
+            sys.exit("({})".format(e))
+        print("Merged {} fixes from {} files, skipped {} with an invalid timestamp."
+              .format(written, len(files), invalid), file=sys.stderr)
+        return
+
+    if not (args.username and args.startdate and args.enddate):
+        parser.error("the following arguments are required: -u, -s, -e")
+
     # set the base URL plus start and end dates
-    urlBase = 'http://map.trackingtheworld.com'
+    urlBase = args.urlbase.rstrip('/')
     startDate = datetime.strptime(args.startdate, '%m-%d-%Y')
     endDate = datetime.strptime(args.enddate, '%m-%d-%Y')
     deltaDate = timedelta(days=1)
@@ -46,48 +424,30 @@ def main():
     if startDate > endDate:
         sys.exit("Start date is after the end date! Please confirm the dates specified.")
 
-    # loop through all the days
+    days = []
     while startDate <= endDate:
-        try:
-            # build our initial request URL
-            urlFirst = urlBase + '/gmap-bmap.aspx?name=' + args.username + '&calDate=' + startDate.strftime('%m/%d/%Y') + '%2012:00:00%20AM&gpasswd=' + args.password
+        days.append(startDate)
+        startDate += deltaDate
 
-            # pull the initial HTML which contains the CSV link
-            r = requests.get(urlFirst)
-            rcontent = r.content
-            soup = BeautifulSoup(rcontent, features='lxml')
-            # grab the CSV link via the "id=HyperLink2" tag
-            a = soup.find(id='HyperLink2', href=True)
+    # download the days concurrently and report them in order
+    failed = 0
+    session = createSession(max(args.jobs, args.connections))
+    limiter = HostLimiter(args.connections)
+    try:
+        state = DownloadState(args.statefile, args.username)
+    except (OSError, ValueError) as e:
+        sys.exit("({})".format(e))
+    with session, ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(
+            lambda day: downloadDay(session, limiter, state, urlBase,
+                                    args.username, args.password, day,
+                                    args.recheck), days)
+        for ok, message in results:
+            print(message)
+            failed += not ok
 
-            # find the CSV link within the HTML
-            try:
-                csvhref = a['href']
-            except TypeError:
-                # if the link can't be found, move on to the next day
-                print("No link found for {}. Continuing...".format(startDate))
-                startDate += deltaDate
-                continue
-
-            # connect to the CSV link and download it
-            fname = csvhref.rsplit('/')[1]
-            csvurl = urlBase + '/archives/' + fname
-            fname = startDate.strftime('%m-%d-%Y') + '-' + fname
-            print("Found CSV download link for {}. Saving as {}...".format(startDate, fname), end = "")
-            r = requests.get(csvurl)
-
-            # write out the CSV as 'date + original filename' to your currect directory
-            try:
-                open(fname, 'wb').write(r.content)
-                print("done.")
-            except Exception as e:
-                sys.exit("({})".format(e))
-
-            # move on to the next day
-            startDate += deltaDate
-        except requests.exceptions.RequestException:
-            sys.exit("Failed to connect to {}. Please check the base URL".format(urlBase))
-        except Exception as e:
-            sys.exit("({})".format(e))
+    if failed:
+        sys.exit("{} of {} days failed.".format(failed, len(days)))
 
 
 if __name__ == "__main__":
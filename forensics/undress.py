@@ -1,22 +1,114 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 #
-# Detect multilayer images and graphic file signatures (slightly broken).
+# Detect multilayer images and graphic file signatures.
 #
 # Author: Derrick Karpo
 # Date: June 3, 2008
 #
+# Notes:
+# o File signatures are checked against a table of magic numbers read
+#   from the first few bytes of each file, and the extension against the
+#   extensions of the signature's format (ie. .jpg, .jpeg and .jfif are
+#   all JPEG).  No image is decoded for a signature check.
+# o Layers and frames are counted straight from the file structure without
+#   decoding, the PSD layer and mask section, GIF image descriptors, APNG
+#   acTL, TIFF IFDs and WebP ANMF chunks.  PNGs with Fireworks private
+#   chunks (mkBF, mkBS, mkTS, mkBT, prVW) hold layers only Fireworks can
+#   show and are reported as multilayer.  The verbose report ('-v') gets
+#   its mode and software from the same parsers, other formats show
+#   'unknown' as no image is decoded.
+# o PIL is only needed to extract layers ('-ll'), which runs in parallel on
+#   the files found to be multilayer.
+#   - $ sudo apt-get install python3-pil
+# o Files are probed by a pool of worker processes ('-j') and a JSON lines
+#   record of each file is streamed as it finishes, to a file with '-o'
+#   (ie. -o records.jsonl or '-' for stdout).  The reports are then read
+#   back from the records, so memory use doesn't grow with the tree.
+#
 
-import glob
 import os
-import sys
 import re
+import sys
+import json
+import struct
 import fnmatch
+import tempfile
+import threading
+import multiprocessing
 
 try:
     from optparse import OptionParser
-    from PIL import Image
 except ImportError:
-    raise ImportError, 'This program requires the OptionParser and PIL extensions for Python.'
+    raise ImportError('This program requires the OptionParser extension for Python.')
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = None
+
+
+# files queued for the workers at once and files per task, a task can't
+# be larger than the queue
+QUEUE_SIZE = 10000
+TASK_SIZE = 64
+
+# bytes read from the start of each file to match a signature
+HEADER_SIZE = 32
+
+# (format, magic) of each supported signature, a magic is a bytes regex
+# matched at the start of the file
+SIGNATURES = [
+    ('JPEG', rb'\xff\xd8\xff'),
+    ('PNG', rb'\x89PNG\r\n\x1a\n'),
+    ('GIF', rb'GIF8[79]a'),
+    ('BMP', rb'BM.{4}\x00\x00\x00\x00'),
+    ('TIFF', rb'II[*+]\x00|MM\x00[*+]'),
+    ('PSD', rb'8BPS\x00[\x01\x02]'),
+    ('ICO', rb'\x00\x00\x01\x00[^\x00]\x00'),
+    ('CUR', rb'\x00\x00\x02\x00[^\x00]\x00'),
+    ('WEBP', rb'RIFF.{4}WEBP'),
+    ('JPEG2000', rb'\x00\x00\x00\x0cjP  \r\n\x87\n|\xff\x4f\xff\x51'),
+    ('HEIF', rb'.{4}ftyp(?:heic|heix|hevc|mif1|msf1|avif)'),
+    ('XCF', rb'gimp xcf '),
+    ('PPM', rb'P[1-7][ \t\r\n#]'),
+    ('PCX', rb'\x0a[\x00-\x05]\x01[\x01\x02\x04\x08]'),
+    ('EPS', rb'%!PS-Adobe-[0-9.]+ EPSF|\xc5\xd0\xd3\xc6'),
+]
+SIGNATURE_PATTERN = re.compile(b'|'.join(b'(?P<%s>%s)' % (name.encode(), magic)
+                                         for name, magic in SIGNATURES), re.DOTALL)
+
+# formats that only hold one image, and those whose layers can't be counted
+SINGLE_IMAGE_FORMATS = ('JPEG', 'BMP', 'ICO', 'CUR', 'JPEG2000', 'PPM', 'PCX', 'EPS')
+
+# PSD color modes and PNG color types as PIL modes
+PSD_MODES = {0: '1', 1: 'L', 2: 'P', 3: 'RGB', 4: 'CMYK', 7: 'Multichannel',
+             8: 'Duotone', 9: 'LAB'}
+PNG_MODES = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+
+# private PNG chunks of Macromedia/Adobe Fireworks layers and pages
+FIREWORKS_CHUNKS = (b'mkBF', b'mkBS', b'mkTS', b'mkBT', b'prVW')
+
+# text chunks larger than this aren't read for the software
+MAX_TEXT_SIZE = 64 * 1024
+
+# extensions that are correct for each format
+FORMAT_EXTENSIONS = {
+    'JPEG': ('.jpg', '.jpeg', '.jpe', '.jfif', '.jif'),
+    'PNG': ('.png', '.apng'),
+    'GIF': ('.gif',),
+    'BMP': ('.bmp', '.dib'),
+    'TIFF': ('.tif', '.tiff'),
+    'PSD': ('.psd', '.psb'),
+    'ICO': ('.ico',),
+    'CUR': ('.cur',),
+    'WEBP': ('.webp',),
+    'JPEG2000': ('.jp2', '.j2k', '.jpf', '.jpx', '.j2c'),
+    'HEIF': ('.heic', '.heif', '.avif'),
+    'XCF': ('.xcf',),
+    'PPM': ('.ppm', '.pgm', '.pbm', '.pnm', '.pam'),
+    'PCX': ('.pcx',),
+    'EPS': ('.eps', '.epsf', '.ps'),
+}
 
 
 def parseOptions():
@@ -31,27 +123,234 @@ def parseOptions():
     parser = OptionParser(usage=usage, description=description)
     parser.add_option("-v", action="store_true", dest="do_verbose",
                       help="Enable verbose mode.  This will classify supported and unsupported files.")
-    parser.add_option("-l", action="count", dest="do_layered",
-                      help="Detect layered images.  Use twice (ie. -ll) to detect and extract layers.")
+    parser.add_option("-l", action="count", dest="do_layered", default=0,
+                      help="Detect layered images.  Use twice (ie. -ll) to detect and extract layers (requires PIL).")
     parser.add_option("-s", action="store_true", dest="do_signature",
                       help="Check file signatures.")
     parser.add_option("-p", action="store", dest="pattern", default='*',
                       help="File or path to read ie. '*.psd' or '*' (defaults to all files).")
     parser.add_option("-d", action="store", dest="directory", default='.',
                       help="Directory to search (defaults to current directory).")
+    parser.add_option("-j", action="store", type="int", dest="jobs",
+                      default=os.cpu_count(),
+                      help="Number of scanning processes (defaults to %default).")
+    parser.add_option("-o", action="store", dest="outfile",
+                      help="Write a JSON lines record of each file to this file "
+                           "('-' for stdout, which skips the reports).")
     (opts, args) = parser.parse_args()
     return (opts, args)
 
 
-def extractLayersPIL(f):
-    """Extract layers from multilayer images using PIL"""
+def readSignature(f):
+    """Return the format of a file from its signature, or None"""
+    with open(f, 'rb') as infile:
+        match = SIGNATURE_PATTERN.match(infile.read(HEADER_SIZE))
+    return match.lastgroup if match else None
+
+
+def extensionMatches(f, format):
+    """Check that the extension of a file is one of its format's"""
+    return os.path.splitext(f)[1].lower() in FORMAT_EXTENSIONS[format]
+
+
+def psdLayers(f):
+    """Return the (layers, mode, software, private) of a PSD/PSB file from
+       the layer count of its layer and mask information section"""
+    version, mode = struct.unpack('>4xH6x2x4x4x2xH', f.read(26))
+
+    # skip the color mode data and image resources sections
+    for section in range(2):
+        (length,) = struct.unpack('>I', f.read(4))
+        f.seek(length, os.SEEK_CUR)
+
+    # PSB uses 8 byte section lengths
+    size = '>Q' if version == 2 else '>I'
+    length = struct.unpack(size, f.read(struct.calcsize(size)))[0]
+    layers = 0
+    if length:
+        if struct.unpack(size, f.read(struct.calcsize(size)))[0]:
+            # negative when the first alpha channel is the merged transparency
+            layers = abs(struct.unpack('>h', f.read(2))[0])
+    return layers, PSD_MODES.get(mode, 'unknown'), 'unknown', False
+
+
+def gifLayers(f):
+    """Return the (frames, mode, software, private) of a GIF by counting
+       its image descriptors"""
+    frames = 0
+
+    def skipSubBlocks():
+        while True:
+            length = f.read(1)
+            if not length or not length[0]:
+                break
+            f.seek(length[0], os.SEEK_CUR)
+
+    # skip the header, logical screen descriptor and global color table
+    header = f.read(13)
+    if len(header) < 13:
+        return frames, 'P', 'unknown', False
+    if header[10] & 0x80:
+        f.seek(3 << ((header[10] & 7) + 1), os.SEEK_CUR)
+    while True:
+        block = f.read(1)
+        if block == b'\x2c':
+            # image descriptor, local color table and image data
+            frames += 1
+            descriptor = f.read(9)
+            if len(descriptor) < 9:
+                break
+            flags = descriptor[8]
+            if flags & 0x80:
+                f.seek(3 << ((flags & 7) + 1), os.SEEK_CUR)
+            f.seek(1, os.SEEK_CUR)
+            skipSubBlocks()
+        elif block == b'\x21':
+            f.seek(1, os.SEEK_CUR)
+            skipSubBlocks()
+        else:
+            break
+    return frames, 'P', 'unknown', False
+
+
+def pngLayers(f):
+    """Return the (frames, mode, software, private) of a PNG from its acTL
+       chunk, the private flag is set by Fireworks layer chunks"""
+    frames = 1
+    mode = software = 'unknown'
+    private = False
+
+    f.seek(8)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk = struct.unpack('>I4s', header)
+        end = f.tell() + length + 4
+
+        if chunk == b'IHDR':
+            mode = PNG_MODES.get(f.read(length)[9], 'unknown')
+        elif chunk == b'acTL':
+            (frames,) = struct.unpack('>I', f.read(4))
+        elif chunk in (b'tEXt', b'iTXt') and length <= MAX_TEXT_SIZE:
+            keyword, _, text = f.read(length).partition(b'\0')
+            if keyword == b'Software':
+                if chunk == b'iTXt':
+                    # skip the compression flag and method, language and
+                    # translated keyword
+                    text = text[2:].split(b'\0', 2)[-1]
+                software = text.decode('latin-1')
+        elif chunk in FIREWORKS_CHUNKS:
+            private = True
+        elif chunk == b'IEND':
+            break
+        f.seek(end)
+    return frames, mode, software, private
+
+
+def tiffLayers(f):
+    """Return the (pages, mode, software, private) of a TIFF or BigTIFF by
+       following its chain of IFDs"""
+    header = f.read(16)
+    order = '<' if header[:2] == b'II' else '>'
+    (magic,) = struct.unpack(order + 'H', header[2:4])
+    if magic == 43:
+        count, entry, offset = order + 'Q', order + 'HHQQ', order + 'Q'
+        (next,) = struct.unpack(order + 'Q', header[8:16])
+    else:
+        count, entry, offset = order + 'H', order + 'HHII', order + 'I'
+        (next,) = struct.unpack(order + 'I', header[4:8])
+
+    pages = 0
+    software = 'unknown'
+    seen = set()
+    while next and next not in seen:
+        seen.add(next)
+        f.seek(next)
+        (entries,) = struct.unpack(count, f.read(struct.calcsize(count)))
+        data = f.read(entries * struct.calcsize(entry))
+        if pages == 0:
+            # the Software tag, an inline or offset ASCII value
+            for tag, kind, length, value in struct.iter_unpack(entry, data):
+                if tag == 305 and kind == 2:
+                    inline = struct.calcsize(offset)
+                    if length <= inline:
+                        raw = struct.pack(offset, value)[:length]
+                    else:
+                        position = f.tell()
+                        f.seek(value)
+                        raw = f.read(min(length, MAX_TEXT_SIZE))
+                        f.seek(position)
+                    software = raw.rstrip(b'\0').decode('latin-1')
+        pages += 1
+        (next,) = struct.unpack(offset, f.read(struct.calcsize(offset)))
+    return pages, 'unknown', software, False
+
+
+def webpLayers(f):
+    """Return the (frames, mode, software, private) of a WebP by counting
+       its ANMF chunks"""
+    frames = 0
+    f.seek(12)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk, length = struct.unpack('<4sI', header)
+        if chunk == b'ANMF':
+            frames += 1
+        f.seek(length + (length & 1), os.SEEK_CUR)
+    return max(frames, 1), 'unknown', 'unknown', False
+
+
+# structural layer or frame counters of each format
+LAYER_PARSERS = {
+    'PSD': psdLayers,
+    'GIF': gifLayers,
+    'PNG': pngLayers,
+    'TIFF': tiffLayers,
+    'WEBP': webpLayers,
+}
+
+
+def probeLayers(f, format):
+    """Return the (mode, layered, software, layers) of an image without
+       decoding it"""
+    if format in SINGLE_IMAGE_FORMATS:
+        return 'unknown', 'singlelayer', 'unknown', 1
+    if format not in LAYER_PARSERS:
+        return 'unknown', 'unknown', 'unknown', None
+
+    with open(f, 'rb') as infile:
+        try:
+            layers, mode, software, private = LAYER_PARSERS[format](infile)
+        except (struct.error, IndexError) as e:
+            raise IOError("truncated or corrupt {}: {}".format(format, e))
+
+    # software detection (useful for detecting pictures that come from
+    # application like 'Macromedia Fireworks MX' which can contain
+    # layers that are only viewable and detectable in their native app
+    if private and software == 'unknown':
+        software = 'Fireworks'
+    if layers > 1 or private:
+        return mode, 'multilayer', software, layers
+    return mode, 'singlelayer', software, layers
+
+
+def extractLayersPIL(record):
+    """Extract layers from multilayer images using PIL, returning the record
+       with the number of layers extracted"""
+    f = record['file']
+    extracted = 0
     try:
-        i = Image.open(f)
-        for index, layer in enumerate(i.layers):
-            i.seek(index)
-            i.save("%s-layer-%03d.jpg" % (f, index))
-    except IOError:
-        return
+        with Image.open(f) as i:
+            for index, layer in enumerate(ImageSequence.Iterator(i)):
+                layer.convert('RGB').save("%s-layer-%03d.jpg" % (f, index))
+                extracted += 1
+    except (IOError, EOFError, ValueError):
+        pass
+    record['extracted'] = extracted
+    return record
 
 
 def locateFiles(pattern, root=os.curdir):
@@ -62,86 +361,156 @@ def locateFiles(pattern, root=os.curdir):
             yield os.path.join(path, filename)
 
 
+def probeFile(job):
+    """Probe and classify a file, returning its result record"""
+    infile, layers, verbose = job
+    record = {'file': infile}
+
+    # match the file signature
+    try:
+        format = readSignature(infile)
+    except IOError as anException:
+        record['error'] = str(anException)
+        return record
+    if format is None:
+        record['error'] = 'unknown file signature'
+        return record
+
+    # signature detection
+    if extensionMatches(infile, format):
+        signature = 'matched'
+    else:
+        signature = 'unmatched'
+
+    # count the layers from the file structure, which is cheap enough to
+    # also fill in the mode and software of the verbose report
+    mode = layered = software = 'unknown'
+    if layers or verbose:
+        try:
+            mode, layered, software, record['layers'] = probeLayers(infile, format)
+        except IOError as anException:
+            if layers:
+                record['error'] = str(anException)
+                return record
+
+    record.update(format=format, mode=mode, signature=signature,
+                  layered=layered, software=software)
+    return record
+
+
+def boundedImap(function, items, jobs):
+    """Map a function over items across worker processes and yield the
+       results as they finish, with at most QUEUE_SIZE items queued at once"""
+    queued = threading.BoundedSemaphore(QUEUE_SIZE)
+
+    def queue():
+        for item in items:
+            queued.acquire()
+            yield item
+
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap_unordered(function, queue(),
+                                          min(TASK_SIZE, QUEUE_SIZE)):
+            queued.release()
+            yield result
+
+
+def scanFiles(files, jobs, layers=False, verbose=False):
+    """Probe files across worker processes and yield their records as they
+       finish"""
+    return boundedImap(probeFile, ((infile, layers, verbose) for infile in files),
+                       jobs)
+
+
+def readRecords(fname):
+    """Yield the records of a JSON lines file"""
+    with open(fname) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def recordSummary(record):
+    """The (format, mode, signature, layered, software) of a record"""
+    return record['format'], \
+           record['mode'], \
+           record['signature'], \
+           record['layered'], \
+           record['software']
+
+
 def main():
     """Runs program and handles command line options"""
-    # variables
-    filesSupported = {}
-    filesUnsupported = {}
-
     # read command line options
     (opts, args) = parseOptions()
 
-    # load 'em up
-    for infile in locateFiles(opts.pattern, opts.directory):
-        # attempt to open the file with PIL
-        try:
-            file, ext = os.path.splitext(infile)
-            i = Image.open(infile)
-        except Exception, anException:
-            filesUnsupported[infile] = anException
-            continue
-
-        # signature detection
-        p = re.compile(i.format, re.IGNORECASE)
-        if p.search(ext):
-            signature = 'matched'
-        else:
-            signature = 'unmatched'
+    if opts.do_layered >= 2 and Image is None:
+        sys.exit("Layer extraction requires PIL.")
 
-        # multilayer detection (could also use i.tell())
-        try:
-            i.seek(1)
-            layered = 'multilayer'
-        except EOFError:
-            layered = 'singlelayer'
-
-        # software detection (useful for detecting pictures that come from
-        # application like 'Macromedia Fireworks MX' which can contain
-        # layers that are only viewable and detectable in their native app
+    # stream the records to a file, a temporary one if none is given
+    if opts.outfile == '-':
+        out = sys.stdout
+    elif opts.outfile:
+        out = open(opts.outfile, 'w')
+    else:
+        out = tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False)
+
+    # load 'em up
+    try:
         try:
-            software = i.info['Software']
-        except:
-            software = "unknown"
+            for record in scanFiles(locateFiles(opts.pattern, opts.directory),
+                                    opts.jobs, opts.do_layered >= 1,
+                                    opts.do_verbose):
+                out.write(json.dumps(record) + '\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if out is not sys.stdout:
+            report(opts, out.name)
+    finally:
+        if not opts.outfile:
+            os.unlink(out.name)
 
-        # done processing
-        filesSupported[infile] = i.format, \
-                                 i.mode, \
-                                 signature, \
-                                 layered, \
-                                 software
 
+def report(opts, fname):
+    """Print the reports from the records file"""
     # now do something
     if opts.do_verbose:
-        if filesSupported:
-            print 'All Supported Files:'
-            for k, v in filesSupported.iteritems():
-                print k, v
-
-        if filesUnsupported:
-            print '\nUnsupported Files:'
-            if filesUnsupported:
-                for k, v in filesUnsupported.iteritems():
-                    print k, v
-            else:
-                print 'None'
-        print
+        print('All Supported Files:')
+        for record in readRecords(fname):
+            if 'error' not in record:
+                print(record['file'], recordSummary(record))
+
+        print('\nUnsupported Files:')
+        unsupported = False
+        for record in readRecords(fname):
+            if 'error' in record:
+                print(record['file'], record['error'])
+                unsupported = True
+        if not unsupported:
+            print('None')
+        print()
 
     if opts.do_layered >= 1:
-        print 'Layered:'
-        for k, v in filesSupported.iteritems():
-            if re.match('multilayer', v[3]):
-                print k, v
-                if opts.do_layered == 2:
-                    extractLayersPIL(k)
-        print
-
-    # *** Signature detection is broken in regards to .jpg != JPEG ***
+        print('Layered:')
+        records = (record for record in readRecords(fname)
+                   if record.get('layered') == 'multilayer')
+        # extract the layers of only the multilayer files in parallel
+        if opts.do_layered >= 2:
+            records = boundedImap(extractLayersPIL, records, opts.jobs)
+        for record in records:
+            if 'extracted' in record:
+                print(record['file'], recordSummary(record),
+                      '%i of %s layers extracted' % (record['extracted'], record['layers']))
+            else:
+                print(record['file'], recordSummary(record), '%s layers' % record['layers'])
+        print()
+
     if opts.do_signature:
-        print 'Bad Signatures:'
-        for k, v in filesSupported.iteritems():
-            if re.match('unmatched', v[2]):
-                print k, v
-        print
+        print('Bad Signatures:')
+        for record in readRecords(fname):
+            if record.get('signature') == 'unmatched':
+                print(record['file'], recordSummary(record))
+        print()
 
 
 if __name__ == "__main__":
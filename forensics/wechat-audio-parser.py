@@ -2,7 +2,7 @@
 #
 # Traverse a directory of WeChat Audio files and do the following:
 #   1. Copy AMR files as is.
-#   2. Convert SILK files with the SILK decoder and further convert to .wav
+#   2. Convert SILK files with the SILK decoder and wrap the raw PCM as .wav
 #   3. Jam a fakey AMR header onto everything else.
 #   4. Optional: Convert all files to .mp3
 #
@@ -14,9 +14,9 @@
 #   - $ git clone https://github.com/ppwwyyxx/wechat-dump.git
 #   - $ wechat-dump/third-party/compile_silk.sh
 #   - $ sudo /bin/cp wechat-dump/third-party/silk/decoder /usr/local/bin
-# o This program requires 'sox' to convert raw SILK files to .wav
-#   - $ sudo apt-get install sox
-# o This program requires 'avconv' to convert .wav files to .mp3
+# o Raw SILK output is wrapped as .wav in-process with the 'wave' module
+#   (16-bit signed, mono, 24000 Hz) so 'sox' is no longer required.
+# o This program requires 'ffmpeg' to convert .wav files to .mp3
 #   - $ sudo apt-get install ffmpeg
 #
 
@@ -24,8 +24,55 @@ import os
 import sys
 import argparse
 import logging
+import wave
 import subprocess
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
+
+
+# fakey AMR header jammed onto unknown files
+AMRHEADER = b'\x23\x21\x41\x4D\x52\x0A'
+
+# raw PCM parameters produced by the SILK decoder
+SILK_SAMPLE_RATE = 24000
+SILK_SAMPLE_WIDTH = 2
+SILK_CHANNELS = 1
+
+# number of header bytes inspected to identify a file
+HEADER_SIZE = 32
+
+# chunk size used when streaming file contents
+CHUNK_SIZE = 1024 * 1024
+
+
+def readHeader(filename):
+    """Return the first HEADER_SIZE bytes of a file"""
+    with open(filename, mode='rb') as input_file:
+        return input_file.read(HEADER_SIZE)
+
+
+def writeAMRHeader(infile, outfile):
+    """Stream a file to outfile with an AMR header prepended"""
+    with open(infile, mode='rb') as input_file, \
+         open(outfile, mode='wb') as output_file:
+        output_file.write(AMRHEADER)
+        copyfileobj(input_file, output_file, CHUNK_SIZE)
+
+
+def convertRawToWav(infile, outfile):
+    """Wrap raw 16-bit signed PCM from the SILK decoder in a .wav container"""
+    with open(infile, mode='rb') as input_file:
+        output_file = wave.open(outfile, 'wb')
+        try:
+            output_file.setnchannels(SILK_CHANNELS)
+            output_file.setsampwidth(SILK_SAMPLE_WIDTH)
+            output_file.setframerate(SILK_SAMPLE_RATE)
+            while True:
+                chunk = input_file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output_file.writeframesraw(chunk)
+        finally:
+            output_file.close()
 
 
 def main():
@@ -75,9 +122,8 @@ def main():
 
     # test if the external applications exist
     SILKDECODER='/usr/local/bin/decoder'
-    SOX='/usr/bin/sox'
     FFMPEG='/usr/bin/ffmpeg'
-    for EXTERNAL_APPLICATION in SILKDECODER, SOX, FFMPEG:
+    for EXTERNAL_APPLICATION in SILKDECODER, FFMPEG:
         if not os.path.isfile(EXTERNAL_APPLICATION):
             logging.info("External application '%s' could not be found.  Exiting."
                          % EXTERNAL_APPLICATION)
@@ -113,52 +159,39 @@ def main():
                     os.makedirs(OUTPUT_FILE_PATH)
 
                 # read in the input file header (first 32 bytes)
-                with open(INPUT_FILE, mode='r', encoding = "ISO-8859-1") as input_file:
-                    HEADER_ORIGINAL_FILE = input_file.read(32)
-                    input_file.close()
-
-                    # test the header to see what it might be, then do stuff!
-                    if 'AMR' in HEADER_ORIGINAL_FILE:
-                        try:
-                            logAMR.debug("'%s' appears to be an AMR file already.  Copying."
-                                         % INPUT_FILE)
-                            copyfile(INPUT_FILE, OUTPUT_FILE)
-                        except:
-                            logAMR.info("Failed to copy '%s'" % OUTPUT_FILE)
-                    elif 'SILK' in HEADER_ORIGINAL_FILE:
-                        # a multi-step process:
-                        #   o run SILK decoder and convert the audio to raw format
-                        #   o run sox and convert the raw audio to .wav format and remove the raw
-                        #   o delete the raw SILK audio file
-                        logSILKConversion.debug("'%s' appears to be a SILK file.  Converting...."
-                                               % INPUT_FILE)
-                        try:
-                            subprocess.check_call([SILKDECODER, INPUT_FILE, OUTPUT_FILE, '-quiet'],
-                                                  stdout=open(os.devnull, 'wb'))
-                            subprocess.check_call([SOX, '-traw', '-b16', '-esigned-integer',
-                                                   '-r24000', OUTPUT_FILE, OUTPUT_FILE + '.wav'],
-                                                  stdout=open(os.devnull, 'wb'))
-                            logSILKConversion.debug("Deleting '%s'." % OUTPUT_FILE)
-                            os.remove(OUTPUT_FILE)
-                        except:
-                            logSILKConversion.info("Failed to write '%s'" % OUTPUT_FILE)
-                    else:
-                        logAMRConversion.debug("'%s' unknown.  Adding AMR header.... "
-                                              % INPUT_FILE)
-                        try:
-                            # read in the entire original file
-                            with open(INPUT_FILE, mode='rb') as input_file:
-                                ENTIRE_ORIGINAL_FILE = input_file.read()
-                                input_file.close()
-
-                                # write out the header + original file contents
-                                AMRHEADER=b'\x23\x21\x41\x4D\x52\x0A'
-                                HEADER_PLUS_FILE = AMRHEADER + ENTIRE_ORIGINAL_FILE
-                                output_file = open(OUTPUT_FILE, "wb")
-                                output_file.write(HEADER_PLUS_FILE)
-                                output_file.close()
-                        except:
-                            logAMRConversion.info("Failed to write '%s'" % OUTPUT_FILE)
+                HEADER_ORIGINAL_FILE = readHeader(INPUT_FILE)
+
+                # test the header to see what it might be, then do stuff!
+                if b'AMR' in HEADER_ORIGINAL_FILE:
+                    try:
+                        logAMR.debug("'%s' appears to be an AMR file already.  Copying."
+                                     % INPUT_FILE)
+                        copyfile(INPUT_FILE, OUTPUT_FILE)
+                    except:
+                        logAMR.info("Failed to copy '%s'" % OUTPUT_FILE)
+                elif b'SILK' in HEADER_ORIGINAL_FILE:
+                    # a multi-step process:
+                    #   o run SILK decoder and convert the audio to raw format
+                    #   o wrap the raw audio in a .wav container
+                    #   o delete the raw SILK audio file
+                    logSILKConversion.debug("'%s' appears to be a SILK file.  Converting...."
+                                           % INPUT_FILE)
+                    try:
+                        subprocess.check_call([SILKDECODER, INPUT_FILE, OUTPUT_FILE, '-quiet'],
+                                              stdout=subprocess.DEVNULL)
+                        convertRawToWav(OUTPUT_FILE, OUTPUT_FILE + '.wav')
+                        logSILKConversion.debug("Deleting '%s'." % OUTPUT_FILE)
+                        os.remove(OUTPUT_FILE)
+                    except:
+                        logSILKConversion.info("Failed to write '%s'" % OUTPUT_FILE)
+                else:
+                    logAMRConversion.debug("'%s' unknown.  Adding AMR header.... "
+                                          % INPUT_FILE)
+                    try:
+                        # write out the header + original file contents
+                        writeAMRHeader(INPUT_FILE, OUTPUT_FILE)
+                    except:
+                        logAMRConversion.info("Failed to write '%s'" % OUTPUT_FILE)
             except OSError as e:
                 logging.info("Failed to open '%s': %s" % (INPUT_FILE, e.strerror))
 